@@ -0,0 +1,120 @@
+import re
+import json
+import time
+import hashlib
+import difflib
+import logging
+import unicodedata
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Resolves free text account names (the MDA spreadsheet) to acct_id through a normalised name key.
+# Matches, and names that matched nothing, are cached in account_name_map, which table_creations keeps between
+# runs. Each entry records the version of the account master it was resolved against and is resolved again
+# once the accounts change.
+
+# Trailing words dropped from a name key, "Acme Holdings, Inc." and "ACME HOLDINGS LLC" share the key "acme holdings"
+LEGAL_SUFFIXES = {
+    "inc", "incorporated", "corp", "corporation", "co", "company", "llc", "llp", "lp", "ltd", "limited",
+    "plc", "gmbh", "ag", "sa", "sas", "sarl", "srl", "spa", "bv", "nv", "ab", "as", "asa", "oy", "kk",
+    "pty", "pte", "pvt", "private"
+}
+# Minimum difflib ratio between keys when there is no exact key match, and how far the best candidate has to be
+# ahead of the next one. Candidates must carry the same numbers as the name, "account 12" is not "account 13".
+FUZZY_CUTOFF = 0.9
+FUZZY_MARGIN = 0.05
+# account_name_map.method for a name that matched no account, cached with an empty acct_id
+NO_MATCH = "none"
+
+# Dots and apostrophes join their neighbours ("S.A." -> "sa", "McDonald's" -> "mcdonalds"), other punctuation splits words
+JOINING = re.compile(r"[.'`]")
+PUNCTUATION = re.compile(r"[^\w\s]|_")
+DIGITS = re.compile(r"\d+")
+
+def name_key(name):
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode()
+    name = name.lower().replace("&", " and ")
+    words = PUNCTUATION.sub(" ", JOINING.sub("", name)).split()
+    if words and words[0] == "the":
+        words = words[1:]
+    while len(words) > 1 and words[-1] in LEGAL_SUFFIXES:
+        words.pop()
+    return " ".join(words)
+
+def account_keys(db):
+    # name key -> acct_ids, more than one when accounts share a name
+    keys = defaultdict(list)
+    for acct_id, account_name in db.execute("select acct_id, account_name from accounts;"):
+        key = name_key(account_name)
+        if key:
+            keys[key].append(acct_id)
+    return keys
+
+def accounts_version(db):
+    # Changes whenever an account is added, removed or renamed
+    digest = hashlib.sha1()
+    for row in db.execute("select acct_id, account_name from accounts order by acct_id;"):
+        digest.update(json.dumps(row).encode())
+    return digest.hexdigest()
+
+def digit_buckets(keys):
+    # Fuzzy candidates are looked up by the numbers in the key, which also keeps each difflib search small
+    buckets = defaultdict(list)
+    for key in keys:
+        buckets[tuple(DIGITS.findall(key))].append(key)
+    return buckets
+
+def fuzzy_match(key, buckets, cutoff=FUZZY_CUTOFF, margin=FUZZY_MARGIN):
+    # Best key with the same numbers as key, or None when nothing passes the cutoff or the runner up is
+    # within margin of it
+    candidates = buckets.get(tuple(DIGITS.findall(key)), [])
+    close = difflib.get_close_matches(key, candidates, n=2, cutoff=cutoff)
+    if not close:
+        return None
+    if len(close) > 1:
+        scores = [difflib.SequenceMatcher(None, key, i).ratio() for i in close]
+        if scores[0] - scores[1] < margin:
+            return None
+    return close[0]
+
+def resolve_names(db, names, cutoff=FUZZY_CUTOFF):
+    # Returns {name: [acct_id, ...]}, names without a match are left out
+    start = time.time()
+    names = set([i for i in names if i])
+    version = accounts_version(db)
+    resolved = defaultdict(list)
+    cached = set()
+    query = "select name, acct_id from account_name_map where accounts_version = ?;"
+    for name, acct_id in db.execute(query, (version,)):
+        if name in names:
+            cached.add(name)
+            if acct_id:
+                resolved[name].append(acct_id)
+
+    pending = names - cached
+    if pending:
+        keys = account_keys(db)
+        buckets = digit_buckets(keys)
+        found = []
+        for name in pending:
+            key = name_key(name)
+            method = "exact"
+            if key not in keys:
+                key, method = fuzzy_match(key, buckets, cutoff), "fuzzy"
+            if key is None:
+                found.append([name, "", name_key(name), NO_MATCH, version])
+                continue
+            for acct_id in keys[key]:
+                resolved[name].append(acct_id)
+                found.append([name, acct_id, name_key(name), method, version])
+        # Entries from an older account master are replaced
+        db.execute("delete from account_name_map where name in (select value from json_each(?));",
+                   (json.dumps(sorted(pending)),))
+        db.insert("account_name_map", ("name", "acct_id", "name_key", "method", "accounts_version"), found)
+
+    logger.info(f"Resolved {len(resolved)} of {len(names)} account names ({len(cached)} cached) "
+                f"in {time.time() - start:.1f} seconds")
+    return resolved
@@ -0,0 +1,81 @@
+import sys
+import gc
+import time
+import random
+import tracemalloc
+from collections import defaultdict
+from summary_rows import summary_table
+
+# Compares the old dict-of-dicts summary rows with summary_table for a synthetic installation summary
+# usage: python bench_summary_rows.py [installations]
+
+METRICS = {
+    "installations": ["sid", "licenses_purchased", "normalized_host_count", "deployment", "last_contact",
+                      "acct_id", "product", "air_gapped", "le", "le_perc", "me", "me_perc", "he", "he_perc",
+                      "cb_alias", "monitoring_partner"],
+    "accounts": ["tier", "arr", "account_name", "csm_score", "csm_comments", "gs_score", "adoption_comments",
+                 "csm", "csm_manager", "cse", "account_manager", "vmw_geo", "vmw_sub_div", "vmw_country", "cs_partner"],
+    "opportunities": ["close_date", "renewal_qt", "forecast", "opp_acv", "opp_count"],
+    "subscriptions": ["sub_product_arr"],
+    "ctas": ["product_usage_analytics", "tech_assessment", "csa_whiteboarding"],
+    "timeline": ["last_timeline"]
+}
+
+def value(field, x):
+    if field.endswith(("count", "arr", "acv", "le", "me", "he", "purchased", "score")):
+        return random.randint(0, 100000)
+    if field.endswith(("date", "contact", "timeline", "analytics", "assessment", "whiteboarding")):
+        return f"2026-{x % 12 + 1:02d}-{x % 28 + 1:02d}"
+    return f"{field}-{x % 5000}"
+
+def metric_queries(n):
+    # One result set per metric query, shaped like execute_columns output
+    for name, fields in METRICS.items():
+        data = [tuple([f"inst{x}"] + [value(f, x) for f in fields]) for x in range(n)]
+        yield ["inst_id"] + fields, data
+
+def old_rows(results):
+    rows = defaultdict(dict)
+    for fields, data in results:
+        for row in data:
+            row_tup = list(zip(fields, row))
+            inst_id = row_tup.pop(0)[1]
+            rows[inst_id].update(dict(row_tup))
+    return rows
+
+def new_rows(results):
+    rows = summary_table("inst_id")
+    for fields, data in results:
+        rows.add(fields, data)
+    return rows
+
+def measure(builder, results):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    rows = builder(results)
+    took = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, current, took
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(1)
+    results = list(metric_queries(n))
+
+    # The query results themselves, for reference
+    gc.collect()
+    tracemalloc.start()
+    data = list(metric_queries(n))
+    data_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+
+    old, old_size, old_time = measure(old_rows, results)
+    del old
+    new, new_size, new_time = measure(new_rows, results)
+    print(f"{n} installations, {sum(len(i) for i in METRICS.values())} summary columns")
+    print(f"query results      {data_size / 2**20:8.1f} MB")
+    print(f"dict of dicts      {old_size / 2**20:8.1f} MB  {old_time:6.2f}s")
+    print(f"summary_table      {new_size / 2**20:8.1f} MB  {new_time:6.2f}s")
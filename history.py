@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import json
+from collections import defaultdict
+from datetime import datetime
+from sqlite_connector import sqlite_db
+
+HISTORY_DB = "history.db"
+
+# Summary tables kept per run and the columns that identify a row across runs
+HISTORY_KEYS = {
+    "acct_summary": ("acct_id", "product"),
+    "inst_summary": ("inst_id", "product")
+}
+
+class history_store(object):
+    def __init__(self, db_file=HISTORY_DB):
+        self.db = sqlite_db(db_file)
+        for table in HISTORY_KEYS:
+            # Row contents are stored once per distinct hash, each run only references them
+            self.db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}_rows (
+            row_hash TEXT PRIMARY KEY,
+            data TEXT
+            ) WITHOUT ROWID;
+            """)
+            self.db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}_runs (
+            run_date TEXT,
+            row_key TEXT,
+            acct_id TEXT,
+            row_hash TEXT,
+            PRIMARY KEY (run_date, row_key)
+            ) WITHOUT ROWID;
+            """)
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_runs_acct on {table}_runs(acct_id, run_date);")
+
+    def record_run(self, src_db, run_date=None):
+        run_date = run_date or datetime.now().strftime("%Y-%m-%d")
+        for table, keys in HISTORY_KEYS.items():
+            fields, data = src_db.execute_columns(f"select * from {table};")
+            key_idx = [fields.index(i) for i in keys]
+            acct_idx = fields.index("acct_id")
+            contents, refs = {}, []
+            for row in data:
+                content = json.dumps(dict(zip(fields, row)), sort_keys=True, default=str)
+                row_hash = hashlib.sha1(content.encode()).hexdigest()
+                contents[row_hash] = content
+                row_key = json.dumps([row[i] for i in key_idx])
+                refs.append((run_date, row_key, row[acct_idx], row_hash))
+            # Re-running on the same day replaces that day's snapshot
+            self.db.cursor.execute("BEGIN TRANSACTION")
+            self.db.cursor.execute(f"DELETE FROM {table}_runs WHERE run_date = ?", (run_date,))
+            self.db.cursor.executemany(f"INSERT OR IGNORE INTO {table}_rows VALUES (?, ?)", contents.items())
+            self.db.cursor.executemany(f"INSERT OR REPLACE INTO {table}_runs VALUES (?, ?, ?, ?)", refs)
+            self.db.cursor.execute("COMMIT")
+        return run_date
+
+    def runs(self, table="acct_summary"):
+        return [i[0] for i in self.db.execute(f"select distinct run_date from {table}_runs order by run_date;")]
+
+    def previous_run(self, run_date, table="acct_summary"):
+        data = self.db.execute(f"select max(run_date) from {table}_runs where run_date < ?;", (run_date,))
+        return data[0][0]
+
+    def diff(self, old_run, new_run, table="acct_summary"):
+        # Only rows whose hash differs between the two runs are loaded and compared
+        query = f"""
+        select n.row_key, n.acct_id, o.row_hash, n.row_hash
+        from {table}_runs n
+        left join {table}_runs o on o.run_date = ? and o.row_key = n.row_key
+        where n.run_date = ?
+        and (o.row_hash is null or o.row_hash != n.row_hash)
+        union all
+        select o.row_key, o.acct_id, o.row_hash, null
+        from {table}_runs o
+        where o.run_date = ?
+        and not exists (select 1 from {table}_runs n where n.run_date = ? and n.row_key = o.row_key)
+        """
+        self.db.cursor.execute(query, (old_run, new_run, old_run, new_run))
+        changed = self.db.cursor.fetchall()
+        hashes = set([i[2] for i in changed if i[2]] + [i[3] for i in changed if i[3]])
+        contents = {}
+        for row_hash in hashes:
+            self.db.cursor.execute(f"select data from {table}_rows where row_hash = ?", (row_hash,))
+            contents[row_hash] = json.loads(self.db.cursor.fetchone()[0])
+
+        report = defaultdict(list)
+        for row_key, acct_id, old_hash, new_hash in changed:
+            if old_hash is None:
+                report[acct_id].append({"key": json.loads(row_key), "status": "added"})
+            elif new_hash is None:
+                report[acct_id].append({"key": json.loads(row_key), "status": "removed"})
+            else:
+                old, new = contents[old_hash], contents[new_hash]
+                changes = {k: [old.get(k), new.get(k)] for k in sorted(set(old) | set(new)) if old.get(k) != new.get(k)}
+                report[acct_id].append({"key": json.loads(row_key), "status": "changed", "changes": changes})
+        return dict(report)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consumption report run history")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="store the current summaries as a run")
+    rec.add_argument("--db", default="onprem_products.db")
+    rec.add_argument("--run-date")
+    sub.add_parser("runs", help="list recorded runs")
+    dif = sub.add_parser("diff", help="per account changes between two runs")
+    dif.add_argument("old_run")
+    dif.add_argument("new_run")
+    dif.add_argument("--table", default="acct_summary", choices=list(HISTORY_KEYS))
+    args = parser.parse_args()
+
+    store = history_store()
+    if args.command == "record":
+        print(store.record_run(sqlite_db(args.db), args.run_date))
+    elif args.command == "runs":
+        print("\n".join(store.runs()))
+    else:
+        print(json.dumps(store.diff(args.old_run, args.new_run, args.table), indent=2, default=str))
@@ -0,0 +1,246 @@
+import os
+import csv
+import sys
+import json
+import time
+import math
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+import sqlite_connector
+from sqlite_connector import sqlite_db
+from synthetic_data import build_database, PRODUCTS
+from onprem_report import create_acct_master, create_inst_master, write_report
+from progress import progress
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+# Scaling run of the pipeline on synthetic databases of increasing size: the sqlite_db insert/update paths
+# (build_database loads every table and computes the derived columns), create_acct_master/create_inst_master
+# and write_report for every installed product. Time and peak memory are kept per stage and size.
+# Peak memory is the process RSS high water mark, reset before each stage where Linux allows it, so it covers
+# SQLite's own allocations. --trace adds tracemalloc's peak of Python allocations, which slows the Python heavy
+# stages down several times over, so timings from a run without it are the ones to compare.
+# A size is not started when the last two sizes predict a stage over --budget seconds, and a stage that runs
+# over it ends the run, so a superlinear stage stops the run instead of leaving it going for hours.
+# usage: python load_test.py [--sizes 1000 10000 100000] [--budget 600] [--out load_test] [--trace] [--keep]
+# Writes <out>.json, <out>.csv and, with matplotlib installed, <out>.png
+
+# 10^6 takes about 20 minutes and several GB for the synthetic rows, run it with --sizes ... 1000000
+SIZES = (1000, 10000, 100000)
+STAGE_BUDGET = 600
+# Exponents above this get a warning, a per row scan inside a join is the usual cause (python query_plans.py check).
+# installations.acct_id declared STRING made the summary builders ~n^2 that way before it became TEXT.
+SUPERLINEAR = 1.3
+RESULTS_FILE = "load_test"
+FIELDS = ("installations", "stage", "seconds", "rows", "peak_rss_mb", "traced_peak_mb")
+
+def reset_peak_rss():
+    # Linux only, elsewhere peak_rss_mb is the high water mark of the whole run so far
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+def measure(results, n, stage, work, trace=False):
+    reset_peak_rss()
+    if trace:
+        tracemalloc.start()
+    start = time.time()
+    rows = work()
+    seconds = time.time() - start
+    traced = None
+    if trace:
+        traced = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+    result = {"installations": n, "stage": stage, "seconds": round(seconds, 3), "rows": rows,
+              "peak_rss_mb": peak_rss_mb(), "traced_peak_mb": traced}
+    results.append(result)
+    print(f"{n:>9} {stage:<40} {seconds:9.2f}s {result['peak_rss_mb']:>9} MB")
+
+def run_size(n, work_dir, trace=False, keep=False, budget=None):
+    # Returns the results and the first top level stage that ran over budget, if any
+    results = []
+    db_file = os.path.join(work_dir, f"load_test_{n}.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    # The insert and update stages build_database goes through are split out from the progress board,
+    # their time is part of load but without the synthetic row generation around them
+    def load():
+        build_database(db_file, n)
+        return n
+    finished = len(progress.finished)
+    measure(results, n, "load", load, trace)
+    # Stages of the same name, e.g. one update installations per derived column, are added together
+    stages = {}
+    for stage in progress.finished[finished:]:
+        seconds, rows = stages.get(stage.name, (0.0, 0))
+        stages[stage.name] = (seconds + stage.elapsed(), rows + stage.count)
+    for name, (seconds, rows) in stages.items():
+        results.append({"installations": n, "stage": f"load {name}", "seconds": round(seconds, 3),
+                        "rows": rows, "peak_rss_mb": None, "traced_peak_mb": None})
+
+    db = sqlite_db(db_file)
+    def masters(create, table):
+        for product in PRODUCTS:
+            create(db, product)
+        return db.execute(f"select count(*) from {table};")[0][0]
+
+    paths = [os.path.join(work_dir, f"load_test_{n}_{product}.xlsx") for product in PRODUCTS]
+    def reports():
+        for product, path in zip(PRODUCTS, paths):
+            write_report(db, product, path, constant_memory=True)
+        return db.execute("select count(*) from acct_summary;")[0][0] + db.execute("select count(*) from inst_summary;")[0][0]
+
+    stages = [("create_acct_master", lambda: masters(create_acct_master, "acct_summary")),
+              ("create_inst_master", lambda: masters(create_inst_master, "inst_summary")),
+              ("write_report", reports)]
+    over = over_budget(results[:1], budget)
+    for stage, work in stages:
+        if over:
+            break
+        measure(results, n, stage, work, trace)
+        over = over_budget(results[-1:], budget)
+
+    db.connection.close()
+    if not keep:
+        for path in [db_file] + paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return results, over
+
+def over_budget(results, budget):
+    for result in results:
+        if budget and result["seconds"] > budget:
+            return result
+    return None
+
+def predict(results, n):
+    # {stage: expected seconds at n} from the exponent between the two largest sizes run so far
+    exponents = scaling(results)
+    largest = max(i["installations"] for i in results)
+    expected = {}
+    for result in results:
+        if result["installations"] == largest and result["stage"] in exponents:
+            expected[result["stage"]] = result["seconds"] * (n / largest) ** exponents[result["stage"]]
+    return expected
+
+def scaling(results):
+    # Exponent of time against size between the two largest sizes, ~1 is linear, ~2 quadratic
+    exponents = {}
+    for stage in dict.fromkeys(i["stage"] for i in results):
+        points = sorted((i["installations"], i["seconds"]) for i in results if i["stage"] == stage)
+        if len(points) < 2:
+            continue
+        (n1, t1), (n2, t2) = points[-2:]
+        if t1 > 0 and t2 > 0 and n2 != n1:
+            exponents[stage] = round(math.log(t2 / t1) / math.log(n2 / n1), 2)
+    return exponents
+
+def write_results(results, out, trace, stopped=None):
+    with open(out + ".json", "w") as f:
+        json.dump({"run_date": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+                   "sqlite": sqlite3.sqlite_version, "chunks": sqlite_connector.CHUNKS, "products": list(PRODUCTS),
+                   "cpus": os.cpu_count(), "tracemalloc": trace, "budget_stop": stopped, "scaling": scaling(results),
+                   "results": results},
+                  f, indent=2)
+    with open(out + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    files = [out + ".json", out + ".csv"]
+    if plt is not None:
+        files.append(plot(results, out + ".png"))
+    return files
+
+def plot(results, path):
+    # Top level stages only, the load breakdown has no memory figures of its own
+    stages = [i for i in dict.fromkeys(i["stage"] for i in results) if not i.startswith("load ")]
+    fig, (times, memory) = plt.subplots(1, 2, figsize=(12, 5))
+    for stage in stages:
+        points = sorted((i["installations"], i["seconds"], i["peak_rss_mb"]) for i in results if i["stage"] == stage)
+        sizes = [i[0] for i in points]
+        times.plot(sizes, [i[1] for i in points], marker="o", label=stage)
+        if all(i[2] is not None for i in points):
+            memory.plot(sizes, [i[2] for i in points], marker="o", label=stage)
+    for ax, label in ((times, "seconds"), (memory, "peak RSS MB")):
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("installations")
+        ax.set_ylabel(label)
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline time and memory against synthetic installation counts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--budget", type=float, default=STAGE_BUDGET, help="seconds a stage may take per size")
+    parser.add_argument("--out", default=RESULTS_FILE, help="results file name without extension")
+    parser.add_argument("--dir", help="where the databases and workbooks go, a temp directory by default")
+    parser.add_argument("--trace", action="store_true", help="tracemalloc peak as well, slows the run down")
+    parser.add_argument("--keep", action="store_true", help="keep the databases and workbooks")
+    args = parser.parse_args()
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix="load_test_")
+    os.makedirs(work_dir, exist_ok=True)
+    results, stopped = [], None
+    for n in sorted(args.sizes):
+        expected = predict(results, n) if results else {}
+        slow = [(stage, seconds) for stage, seconds in expected.items() if seconds > args.budget]
+        if slow:
+            stage, seconds = max(slow, key=lambda i: i[1])
+            stopped = {"installations": n, "stage": stage, "seconds": round(seconds), "predicted": True}
+            print(f"Not running {n} installations, {stage} would take about {seconds:.0f}s (budget {args.budget}s)")
+            break
+        sized, over = run_size(n, work_dir, args.trace, args.keep, args.budget)
+        results += sized
+        if over:
+            stopped = dict(over, predicted=False)
+        # Written after every size so a long run that is stopped part way still leaves its results
+        files = write_results(results, args.out, args.trace, stopped)
+        if over:
+            print(f"Stopped at {n} installations, {over['stage']} took {over['seconds']:.0f}s (budget {args.budget}s)")
+            break
+    if stopped and stopped["predicted"]:
+        files = write_results(results, args.out, args.trace, stopped)
+    if not args.keep and not args.dir:
+        os.rmdir(work_dir)
+    largest = {}
+    for result in results:
+        largest[result["stage"]] = result["seconds"]
+    for stage, exponent in scaling(results).items():
+        # Stages under a second are mostly noise
+        warning = "  superlinear, check the query plans" if exponent > SUPERLINEAR and largest[stage] >= 1 else ""
+        print(f"{stage:<40} time ~ n^{exponent}{warning}")
+    print(f"Results written to {', '.join(files)}")
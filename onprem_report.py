@@ -1,81 +1,76 @@
 import json
+import glob
+import hashlib
+import asyncio
 import trino
 import xlsxwriter
 import dateparser
 import os
+import re
+import logging
+import argparse
 import openpyxl
 from collections import defaultdict
-from sqlite_connector import sqlite_db
-from tesseract_connector import tesseract_connection
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import sqlite_connector
+from sqlite_connector import sqlite_db, spill_result
+from tesseract_connector import tesseract_connection, async_tesseract_connection
+from snapshot_export import export_snapshots
+from history import history_store
+from summary_rows import summary_table
+from account_names import resolve_names
+from product_catalog import catalog, sql_list
+from summary_queries import QUERIES, summary_params, run_summary, shard_tables, refresh_metrics, acct_shard, cta_column
+from query_telemetry import telemetry, traced, merged
+from progress import progress
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Gainsight CTA reasons pulled into the ctas table -> report heading. Each gets a summary column named by
+# cta_column, the summary DDL and report columns below are built from this so adding a reason is one entry.
+CTA_TYPES = {
+    "Product Usage Analytics": "Last CUA",
+    "Tech Assessment": "Last TA",
+    "CSA Whiteboarding": "Last WB"
+}
+CTA_DDL = "\n".join(f"{cta_column(i)} TEXT," for i in CTA_TYPES)
+CTA_REPORT_COLUMNS = "\n".join(f'{cta_column(i)} as "{heading}",' for i, heading in CTA_TYPES.items())
+
+def alias_key(alias):
+    # Carbon Black aliases are compared lowercase with - and _ treated the same
+    if alias is None:
+        return None
+    return str(alias).strip().lower().replace("-", "_") or None
+
 class report_data(object):
 
-    def __init__(self):
+    def __init__(self, db_file="onprem_products.db", connect=True):
         self.customers = {}
         self.nulls = defaultdict(list)
-        self.sfdb = tesseract_connection()
-        self.db = sqlite_db("onprem_products.db")
-        self.inst_ids = self.get_initial_list()
-        self.act_dict = self.get_account_translation()
+        self.db = sqlite_db(db_file)
+        # connect=False works on an already loaded database, e.g. the synthetic benchmark data
+        if connect:
+            self.sfdb = tesseract_connection()
+            self.act_dict = self.get_initial_list()
 
     def get_initial_list(self):
-        query = f"""
-        select i.installation_18_digit_id__c
-        from edw_tesseract.sbu_ref_sbusfdc.installation__c i
-        left join edw_tesseract.sbu_ref_sbusfdc.account a on i.account__c = a.id
-        where  1=1
-        --and a.cs_tier__c in ('Low', 'Medium', 'High', 'Holding')
-        and i.product_group__c in ('Cb Protection', 'Cb Response', 'Cb Response Cloud')
-        and i.installation_type__c in ('Perpetual', 'Subscription')
-        and i.install_type__c in ('Partner', 'MSSP - Cb Protection', 'IR - Carbon Black', 'Other', 'General Availability', 'Bit9 Deployment', 'Initial purchase')
-        and (i.cb_cloud_status__c not in ('Destroyed', 'Shutdown') or i.cb_cloud_status__c is null)
-        and (i.status__c in ('New', 'In-Progress', 'Complete') or i.status__c is null)
-        """
-        query = """
+        # Picks the installations in scope, used as a subquery so the bootstrap is one round trip
+        inst_query = f"""
         select distinct i.installation_18_digit_id__c
         from edw_tesseract.sbu_ref_sbusfdc.installation__c i
         left join edw_tesseract.sbu_ref_sbusfdc.bit9_subscriptions__c s on i.account__c = s.account__c
         where  1=1
         and s.active_subscription__c = True
-        and s.product_group__c in ('Cb Response Cloud')
-        """
-        data = self.sfdb.execute(query)
-        accts = ('0010h00001Znvh6AAB', '0013400001SaPxVAAV', '0018a00001kw5hxAAA', '0010h00001aAfkGAAS', '0010h00001ZmktrAAB', '0013400001QSgD4AAL', '0013400001P0HwuAAF', '0010h00001ZnFEbAAN', '0013400001LOZkpAAH', '0013400001OztdXAAR', '0010h00001ZxoPlAAJ', '0010h00001ZmwRpAAJ', '0018a00001kvSyyAAE', '0013400001NdRITAA3', '0010h00001cxYNfAAM', '0013400001TGxTkAAL', '0010h00001azAyIAAU', '0010h00001Ys8kpAAB', '0010h00001jTGDsAAO', '0013400001UaofUAAR', '0010h00001jTxn6AAC', '0010h00001ZmiR5AAJ',
- '0010h00001Zml2SAAR', '0010h00001dwigpAAA', '0013400001UOVktAAH', '0013400001S2lO8AAJ', '0010h00001ktg8NAAQ', '0013400001Rpc17AAB', '0013400001UqG0pAAF', '0010h00001Zn4SvAAJ', '0018000001CxkZjAAJ', '0013400001Pj8oRAAR', '0010h00001duwPBAAY', '0010h00001ZmumFAAR', '0018000001IncHMAAZ', '0010h00001Ys9iBAAR', '0010h00001k8bRtAAI', '0010h00001aAzkDAAS', '0018000001InODdAAN', '00180000014eJ43AAE', '0013400001QyqelAAB', '0013400001V04e9AAB', '0013400001TFGFjAAP', '0010h00001jUxEQAA0',
- '0010h00001cDXpRAAW', '0013400001MCE1LAAX', '0018a00001kvoGNAAY', '0010h00001jVPLpAAO', '0010h00001ZmyomAAB', '0010h00001cyd5tAAA', '0013400001RS5O5AAL', '0010h00001Zo9VXAAZ', '0010h00001YplmqAAB', '0018a00001mrv9DAAQ', '0013400001VSfGjAAL', '0013400001S0PH6AAN', '0010h00001YqcxOAAR', '0013400001WftwoAAB', '0010h00001ZmsOCAAZ', '0013000000D83bCAAR', '0010h00001dvcDRAAY', '0018a00001kvuf4AAA', '0013400001W6kPIAAZ', '0013400001T5oQ5AAJ', '0018000000rgdUJAAY', '0018000000h1vqAAAQ',
- '0010h00001ayuCDAAY', '0013400001T5k7wAAB', '0018000001FZEK7AAP', '0013400001WGrzHAAT', '0013400001LN9bZAAT', '0013400001V9DEdAAN', '0013000000DBENbAAP', '0010h00001Zx2CRAAZ', '0018a00001lamYPAAY', '0010h00001Zmm8KAAR', '0018a00001nAObCAAW', '0010h00001ZnGlOAAV', '0010h00001ZnK24AAF', '0013400001OZ12ZAAT', '0010h00001ayKhHAAU', '0018000000vcOubAAE', '0013000000D7sLaAAJ', '0013400001QUDReAAP', '0013400001M20mLAAR', '0013000000DBEI5AAP', '0010h00001YtKvvAAF', '0013000000FIm9TAAT',
- '0013400001TE7MQAA1', '0013400001K1KNvAAN', '0010h00001Ysny6AAB', '0010h00001iyGj1AAE', '0010h00001avpS9AAI', '0010h00001fdaE2AAI', '0010h00001dxncbAAA', '0010h00001YbafGAAR', '0013400001JVVBQAA5', '0013400001UcogtAAB', '0013400001W56lfAAB', '0010h00001iM0ZtAAK', '0013400001K2YnzAAF', '0013000000JgbzPAAR', '0010h00001ZnIlCAAV', '0013400001K234wAAB', '0010h00001a9L4QAAU', '0018000000wZ1pAAAS', '0018a00002GKS64AAH', '0018a000026xSi4AAE', '0010h00001aAgGaAAK', '0010h00001j6W7YAAU',
- '0013400001T5nf3AAB', '0013000000LW1RSAA1', '0010h00001cDUllAAG', '0010h00001ZmzfhAAB', '0010h00001iihGzAAI', '0013000000HISG0AAP', '0013400001SwAOtAAN', '0013400001MuK8eAAF', '0018000000rfgEzAAI', '0010h00001ktycuAAA', '0010h00001f3qNkAAI', '0010h00001Zmlf9AAB', '0010h00001ayB38AAE', '0010h00001ZxJboAAF', '0010h00001dwAq8AAE', '0010h00001fcKxTAAU', '0018a00001mnGOfAAM', '0018000000MfM82AAF', '0010h00001jSoBQAA0', '0010h00001ktCkcAAE', '0013400001K2t2pAAB', '0013400001RQVu8AAH',
- '0013000000EOPEZAA5', '0018000001HFPe6AAH', '0013000000D8jW6AAJ', '0010h00001YpdiLAAR', '0013400001UODidAAH', '0013400001WfonkAAB', '0013400001TEvFrAAL', '0010h00001jUoKdAAK', '0013400001WOyBKAA1', '0010h00001duFjCAAU', '0013000000E1Xk6AAF', '0010h00001ktFr7AAE', '0010h00001YqMiLAAV', '0013400001VehCSAAZ', '0013400001K0w5BAAR', '0018a00001w7AkmAAE', '0010h00001azQX1AAM', '0013400001LOHiEAAX', '0010h00001Ysl7LAAR', '0013400001QUhRlAAL', '0013000000DBEJ7AAP', '0013400001LO7hxAAD',
- '0018000001BVw48AAD', '0013400001NdIsTAAV', '0013400001RS9zaAAD', '0013400001TGMTLAA5', '0018000001GMaxpAAD', '0018000000Lixr7AAB', '0010h00001kt5NiAAI', '0010h00001hZ6ScAAK', '0013400001QUVsJAAX', '00180000018r7TyAAI', '0010h00001ikBPhAAM', '0013000000E1XgFAAV', '0018a00001upWJ5AAM', '0010h00001ZmYroAAF', '0010h00001ayDhmAAE', '0010h00001cDnpVAAS', '0010h00001ZmmDzAAJ', '0013400001NcjL3AAJ', '0013400001UMqZFAA1', '0013400001VecpCAAR', '0010h00001Zn1HlAAJ', '0013400001UsbniAAB',
- '0013400001TGWsdAAH', '0010h00001Zn492AAB', '0013400001UNv8lAAD', '0010h00001ksleMAAQ', '0010h00001cDeRjAAK', '0013400001QSS4GAAX', '0010h00001cxVF4AAM', '0010h00001ZmTxpAAF', '0013400001OxdQpAAJ', '0010h00001k8tRYAAY', '0010h00001duFuZAAU', '0010h00001ZoPRyAAN', '0013000000FIm9mAAD', '0010h00001ZofwMAAR', '0010h00001ZmsDHAAZ', '0013400001NcgdZAAR', '0010h00001k8i4oAAA', '0013400001Ubkh7AAB', '0013000000DT2ESAA1', '0013400001L1CNuAAN', '0018a00001n7e3oAAA', '0018a00001kuvInAAI',
- '0013000000D7sm8AAB', '0010h00001ZxZiWAAV', '0010h00001dwiiCAAQ', '0010h00001YsjVFAAZ', '0010h00001fcvaCAAQ', '0013400001TEzHTAA1', '0010h00001fdMyQAAU', '0010h00001dwA2GAAU', '0010h00001a9ntYAAQ', '0013000000D7scPAAR', '0010h00001aAAesAAG', '0013400001RTNiuAAH', '0013400001MD7LoAAL', '0018000001IqN4vAAF', '0010h00001YrjGSAAZ', '0010h00001aAiGkAAK', '0013400001T5s8cAAB', '0013400001MCnBfAAL', '0013400001KGnGqAAL', '0018000000p5Mj9AAE', '0010h00001cDpRsAAK', '0018000001HzuoOAAR',
- '0013400001UcYMGAA3', '0013400001T5oFgAAJ', '0013400001VhAv4AAF', '0018000000OOqjbAAD', '0013400001T5FMgAAN', '0010h00001YsfOxAAJ', '0010h00001f3vP5AAI', '0013400001RrEvzAAF', '0013400001M1PBtAAN', '0013000000D8jIZAAZ', '0010h00001ZnG01AAF', '0010h00001d1JCtAAM', '0010h00001ik0F0AAI', '0010h00001azVnvAAE', '0010h00001ik1xTAAQ', '0018a00001kvYhLAAU', '0013400001VV8HjAAL', '0013400001T5FaJAAV', '0010h00001Zn1RdAAJ', '0018000001BxCSEAA3', '0013400001OYjqUAAT', '0010h00001ikBrJAAU',
- '0013000000DBEIPAA5', '0013400001WNeGFAA1', '0018a00001upacwAAA', '0010h00001YseA8AAJ', '0010h00001cyxwEAAQ', '0013400001K2QO2AAN', '0010h00001cy788AAA', '0018a00001mEbxCAAS', '0010h00001Zn95OAAR', '0013400001SYQxIAAX', '0013400001THHQOAA5', '0013400001P0YZCAA3', '0013000000D8iBRAAZ', '0013400001SwOKgAAN', '0010h00001ZnHd1AAF', '0013400001TGHQyAAP', '0010h00001YrlwJAAR', '0013400001R2UXKAA3', '0018a00001zewUiAAI', '0013400001RQoqgAAD', '0013400001V0x3HAAR', '0010h00001Zy1qlAAB',
- '0013000000D8jEsAAJ', '0013400001Nbfd8AAB', '0010h00001axmUJAAY', '0013400001UMxo2AAD', '0018000000udyYCAAY', '0013000000EN7xkAAD', '0013000000EOPGrAAP', '0013400001JYUMzAAP', '0013400001RProGAAT', '0013400001NcODYAA3', '0013400001P0LTaAAN', '0010h00001ZnGrEAAV', '0010h00001d0xvuAAA', '0013400001S0yA2AAJ', '0013400001TFFEfAAP', '0013400001PhwtGAAR', '0010h00001jSvnDAAS', '0010h00001ZnKxTAAV', '0010h00001YpYrQAAV', '0010h00001ZnHm8AAF', '0010h00001YpdagAAB', '0010h00001ktcfOAAQ',
- '0013400001PjDN6AAN', '0010h00001j6p26AAA', '0010h00001YqWPjAAN', '0010h00001aA4eMAAS', '0013400001K0p1GAAR', '0013400001LOuk6AAD', '0013400001T5sG7AAJ', '0013400001RFUl7AAH', '0013400001NbrJgAAJ', '0010h00001ksnxOAAQ', '0013400001QRNM9AAP', '0013400001UMXtzAAH', '0010h00001dx1P0AAI', '0010h00001ZnJzcAAF', '0010h00001jUTdRAAW', '0013000000KwZF1AAN', '0013000000DT1AnAAL', '0018000000koKF0AAM', '00180000010jjbZAAQ', '0013400001SwE3FAAV', '0018000001IWI0uAAH', '0013400001MuaKkAAJ',
- '0013400001OwxDyAAJ', '0013400001T5jwFAAR', '0013400001OFz0uAAD', '0013000000D8iunAAB', '0010h00001Zn6vBAAR', '0013400001LOGQJAA5', '0013400001S3LB5AAN', '0013400001T5GPSAA3', '0013400001M1xwVAAR', '0018a000023dcIxAAI', '0013400001TFcdwAAD', '0013400001Wg4AnAAJ', '0013000000DBEDMAA5', '0010h00001cy16gAAA', '0010h00001ZxIJZAA3', '0018000000xRzTKAA0', '0010h00001dureqAAA', '0018a00001kvLuqAAE', '0010h00001hKcwpAAC', '0013400001LNvkTAAT', '0013400001SZlH7AAL', '0018000001G3RM7AAN',
- '0010h00001YrNhPAAV', '0013400001Sw6DaAAJ', '0013400001JWjr1AAD', '0018a00001ze5T8AAI', '0010h00001iwXz9AAE', '0010h00001axD2OAAU', '0013400001THK5kAAH', '0013400001MuMnCAAV', '0010h00001ZnEyLAAV', '0010h00001ZnJdVAAV', '0010h00001Ys1STAAZ', '0013400001L0yyMAAR', '0013000000D8jABAAZ', '0010h00001aAo3ZAAS', '0013400001JVB5zAAH')
-        accts = "'" + "', '".join(accts) + "'"
-        query = f"""
-        select distinct i.installation_18_digit_id__c
-        from edw_tesseract.sbu_ref_sbusfdc.installation__c i 
-        where 1=1
-        and i.product_group__c like '%Cb Response Cloud%'
-        and i.account__c in ({accts})
+        and s.product_group__c in ({sql_list(catalog.report_products)})
         """
-
-        # Insert into db just the inst_ids
-        fields = ["inst_id"]
-        self.db.insert("installations", fields, data)
-
-        # Return a string that can be used in subsequent queries
-        data = [i[0] for i in data]
-        data = "'" + "', '".join(data) + "'"
-        return data
-
-    def get_installation_info(self):
         query = f"""
         select i.installation_18_digit_id__c,
         i.licenses_purchased__c,
@@ -87,31 +82,27 @@ class report_data(object):
         i.monitor_count__c,
         i.block_ask_count__c,
         i.lockdown_count__c,
-        LOWER(i.carbon_black_alias__c),
+        i.carbon_black_alias__c,
         mp.name
         from edw_tesseract.sbu_ref_sbusfdc.installation__c i
         left join edw_tesseract.sbu_ref_sbusfdc.account mp on i.monitoring_partner__c = mp.account_id_18_digits__c
-        where i.installation_18_digit_id__c in ({self.inst_ids})
+        where i.installation_18_digit_id__c in ({inst_query})
         """
         data = self.sfdb.execute(query)
+        # Decimals are converted by insert from the installations DDL
+        data = spill_result(rows=(list(row[:10]) + [alias_key(row[10]), row[11]] for row in data))
         fields = ("inst_id", "licenses_purchased", "normalized_host_count", "last_contact", "acct_id", "product",\
                  "sid", "le", "me", "he", "cb_alias", "monitoring_partner")
-        self.db.update("installations", fields, data)
+        self.db.insert("installations", fields, data)
 
-    def get_account_translation(self):
-        query = f"""
-        select i.account__c, i.id from
-        edw_tesseract.sbu_ref_sbusfdc.installation__c i
-        where i.installation_18_digit_id__c in ({self.inst_ids})
-        and i.account__c is not Null
-        """
-        data = self.sfdb.execute(query)
+        # Account translation from the same rows
         act_dict = defaultdict(list)
-        for act_id, inst_id in data:
-            act_dict[act_id].append(inst_id)
+        for row in data:
+            if row[4] is None: continue
+            act_dict[row[4]].append(row[0])
         return act_dict
 
-    def get_account_info(self):
+    def account_extract(self):
         accts = "'" + "', '".join(self.act_dict.keys()) + "'"
         query = f"""
         select
@@ -138,13 +129,19 @@ class report_data(object):
         left join edw_tesseract.sbu_ref_sbusfdc.account csp on a.cs_partner__c = csp.account_id_18_digits__c
         where a.account_id_18_digits__c in ({accts})
         """
-        data = self.sfdb.execute(query)
         fields = ["acct_id", "tier", "arr", "account_name", "csm_score", "csm_comments"]
         fields += ["gs_score", "adoption_comments", "csm", "csm_manager", "cse", "account_manager"]
         fields += ["vmw_geo", "vmw_sub_div", "vmw_country", "cs_partner"]
-        self.db.insert("accounts", fields, data)
+        return "accounts", fields, query
 
-    def get_opportunity_info(self):
+    def get_account_info(self):
+        table, fields, query = self.account_extract()
+        data = self.sfdb.execute(query)
+        self.db.insert(table, fields, data)
+
+    def opportunity_extract(self, next_renewal=False):
+        if next_renewal:
+            return self.next_renewal_extract()
         accts = "'" + "', '".join(self.act_dict.keys()) + "'"
         query = f"""
         select o.id,
@@ -158,11 +155,61 @@ class report_data(object):
         and o.closedate > CURRENT_DATE
         and o.type like '%Renewal%'
         """
-        data = self.sfdb.execute(query)
         fields = ("opp_id", "acct_id", "acv", "forecast", "close_date", "type")
-        self.db.insert("opportunities", fields, data)
+        return "opportunities", fields, query
 
-    def get_subscription_info(self):
+    def get_opportunity_info(self, next_renewal=False):
+        table, fields, query = self.opportunity_extract(next_renewal)
+        data = self.sfdb.execute(query)
+        self.db.insert(table, fields, data)
+
+    def next_renewal_extract(self):
+        # Classify each renewal by product family and keep only the next one per account/product
+        accts = "'" + "', '".join(self.act_dict.keys()) + "'"
+        families = ""
+        for prod, fams in catalog.renewal_families().items():
+            families += f"when trim(f.family) in ({sql_list(fams)}) then {sql_list([prod])}\n"
+        query = f"""
+        with families as (
+            select distinct o.id,
+            o.accountid,
+            o.acv_amount__c,
+            o.cb_forecast__c,
+            o.closedate,
+            case
+            {families}
+            end as product
+            from edw_tesseract.sbu_ref_sbusfdc.opportunity o
+            cross join unnest(split(o.product_family__c, ';')) as f(family)
+            where o.accountid in ({accts})
+            and o.closedate > CURRENT_DATE
+            and o.type like '%Renewal%'
+        )
+        select accountid,
+        product,
+        id,
+        acv_amount__c,
+        cb_forecast__c,
+        closedate,
+        opp_count
+        from (
+            select *,
+            row_number() over (partition by accountid, product order by closedate, id) as rn,
+            count(*) over (partition by accountid, product) as opp_count
+            from families
+            where product is not null
+        ) ranked
+        where rn = 1
+        """
+        fields = ("acct_id", "product", "opp_id", "acv", "forecast", "close_date", "opp_count")
+        return "next_renewal", fields, query
+
+    def get_next_renewal_info(self):
+        table, fields, query = self.next_renewal_extract()
+        data = self.sfdb.execute(query)
+        self.db.insert(table, fields, data)
+
+    def subscription_extract(self):
         accts = "'" + "', '".join(self.act_dict.keys()) + "'"
         query = f"""
         select account__c,
@@ -179,29 +226,91 @@ class report_data(object):
         where active_subscription__c = true
         and account__c in ({accts})
         """
-        data = self.sfdb.execute(query)
         fields = ["acct_id", "arr", "end_date", "sub_id"]
         fields += ["description", "product_id", "product"]
         fields += ["quantity", "sub_term", "tcv"]
-        self.db.insert("subscriptions", fields, data)
+        return "subscriptions", fields, query
+
+    def get_subscription_info(self):
+        table, fields, query = self.subscription_extract()
+        data = self.sfdb.execute(query)
+        self.db.insert(table, fields, data)
 
-    def get_cta_info(self):
+    def cta_extract(self, cta_types=CTA_TYPES):
+        # One pass over gsctadataset for every cta type, latest closed date per account/type/status
         accts = "'" + "', '".join(self.act_dict.keys()) + "'"
-        for cta_type in ("Product Usage Analytics", "Tech Assessment", "CSA Whiteboarding"):
-            fields = ("acct_id", "cta_type", "closed_date", "status")
-            query = f"""
-            select account_id,
-            '{cta_type}',
-            max(closed_date),
-            case when status in ('New','Work In Progress') then 'Open' else 'Closed' end
-            from edw_tesseract.sbu_ref_sbusfdc.gsctadataset
-            where reason like '{cta_type}'
-            and account_id in ({accts})
-            and status not in ('Closed No Action', 'Closed Unsuccessful', 'Closed Invalid')
-            group by account_id, status, closed_date
-            """
-            data = self.sfdb.execute(query)
-            self.db.insert("ctas", fields, data)
+        query = f"""
+        select account_id,
+        reason,
+        max(closed_date),
+        case when status in ('New','Work In Progress') then 'Open' else 'Closed' end as cta_status
+        from edw_tesseract.sbu_ref_sbusfdc.gsctadataset
+        where reason in ({sql_list(cta_types)})
+        and account_id in ({accts})
+        and status not in ('Closed No Action', 'Closed Unsuccessful', 'Closed Invalid')
+        group by account_id, reason, case when status in ('New','Work In Progress') then 'Open' else 'Closed' end
+        """
+        fields = ("acct_id", "cta_type", "closed_date", "status")
+        return "ctas", fields, query
+
+    def get_cta_info(self, cta_types=CTA_TYPES):
+        table, fields, query = self.cta_extract(cta_types)
+        data = self.sfdb.execute(query)
+        self.db.insert(table, fields, data)
+
+    async def load_async(self, next_renewal=False, max_concurrency=4, queue_size=8):
+        # Stream the account level extracts concurrently, one writer task owns a sqlite connection of its own
+        # and runs the inserts in a worker thread so the event loop keeps fetching while a batch is written
+        extracts = [self.account_extract(), self.opportunity_extract(next_renewal),
+                    self.subscription_extract(), self.cta_extract()]
+        sfdb = async_tesseract_connection(max_concurrency)
+        queue = asyncio.Queue(maxsize=queue_size)
+        # Row counts aren't known up front, each extract reports rows written and rate
+        stages = {table: progress.stage(f"extract {table}") for table, fields, query in extracts}
+
+        async def produce(table, fields, query):
+            async for batch in sfdb.iterate(query):
+                # Blocks when the writer falls behind
+                await queue.put((table, fields, batch))
+            await queue.put((table, fields, None))
+
+        async def write():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                table, fields, batch = item
+                if batch is None:
+                    stages[table].done()
+                    continue
+                # Shielded so cancelling the writer doesn't close the connection under a running insert
+                inserting[0] = asyncio.ensure_future(
+                    asyncio.to_thread(writer_db.insert, table, fields, batch, stage=stages[table]))
+                await asyncio.shield(inserting[0])
+
+        # to_thread may pick a different pool thread per batch, the inserts are still one at a time
+        writer_db = sqlite_db(self.db.db_file, check_same_thread=False)
+        inserting = [None]
+        writer = asyncio.create_task(write())
+        producers = asyncio.gather(*[produce(*i) for i in extracts])
+        try:
+            # The writer only finishes early if an insert failed
+            await asyncio.wait([producers, writer], return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                writer.result()
+            await producers
+            # The writer can still fail with the queue full, which would leave the last put waiting forever
+            stop = asyncio.ensure_future(queue.put(None))
+            await asyncio.wait([stop, writer], return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            await writer
+        finally:
+            producers.cancel()
+            writer.cancel()
+            await asyncio.gather(writer, *[i for i in inserting if i], return_exceptions=True)
+            writer_db.connection.close()
+            for stage in stages.values():
+                stage.done()
 
     def renewal_quarter(self):
         def lookup_q(opp_date):
@@ -256,11 +365,12 @@ class report_data(object):
                         finding = f"{year} {q}"
             return finding
 
-        query = "select opp_id, close_date from opportunities;"
-        data = self.db.execute(query)
-        data = [[i[0], lookup_q(i[1])] for i in data]
         fields = ("opp_id", "renewal_qt")
-        self.db.update("opportunities", fields, data)
+        for table in ("opportunities", "next_renewal"):
+            query = f"select opp_id, close_date from {table};"
+            data = self.db.execute(query)
+            data = [[i[0], lookup_q(i[1])] for i in data]
+            self.db.update(table, fields, data)
 
     def deployment_percentage(self):
         query = "select inst_id, normalized_host_count, licenses_purchased from installations;"
@@ -294,25 +404,25 @@ class report_data(object):
             self.db.update("installations", fields, percs)
 
     def air_gapped(self):
-        for product in ("Cb Protection", "Cb Response", "Cb Response Cloud"):
-            query = f"""
-            select
-            i.inst_id,
-            case
-            when i.last_contact >
-                DATE((select max(last_contact) from installations where product = '{product}'), '-5 Days')
-                then False else True end
-            from installations i
-            where i.product = '{product}';
-            """
-            data = self.db.execute(query)
-            fields = ("inst_id", "air_gapped")
+        fields = ("inst_id", "air_gapped")
+        for product in catalog.installed:
+            data = self.db.execute(QUERIES["air_gapped"], summary_params(product))
             self.db.update("installations", fields, data)
 
     def product_family(self):
-        query = "select distinct type from opportunities;"
-        data = [i[0] for i in self.db.execute(query)]
-        products = set([i for prods in data for i in prods.split(";")])
+        # Tokenise product strings once into the product_codes bridge table
+        queries = {
+            "opportunities": "select opp_id, acct_id, type from opportunities where type is not null;",
+            "subscriptions": "select rowid, acct_id, product from subscriptions where product is not null;",
+            "installations": "select inst_id, acct_id, product from installations where product is not null;"
+        }
+        data = []
+        for source, query in queries.items():
+            for row_id, acct_id, prods in self.db.execute(query):
+                codes = set([catalog.code(i) for i in prods.split(";") if i.strip()])
+                data += [[source, str(row_id), acct_id, code] for code in codes]
+        fields = ("source", "row_id", "acct_id", "product_code")
+        self.db.insert("product_codes", fields, data, del_table=True)
 
     def get_s3(self):
         xlsx_file = "HEDR Hosted S3 Buckets.xlsx"
@@ -320,13 +430,27 @@ class report_data(object):
         wb = openpyxl.load_workbook(xlsx_file, data_only=True)
         s = wb["Instances"]
         for x, i in enumerate(s.rows):
-            alias = s.cell(row=x+1, column=1).value.lower().replace("-", "_")
+            alias = s.cell(row=x+1, column=1).value
             bucket = s.cell(row=x+1, column=2).value
             data.append([alias, bucket])
+        self.load_aliases(data)
+
+    def load_aliases(self, data):
+        # One row per normalised alias from the bucket list (data is [alias, bucket]) and from installations,
+        # installation only aliases have no bucket
+        buckets = {}
+        for alias, bucket in data:
+            alias = alias_key(alias)
+            if alias and (bucket or alias not in buckets):
+                buckets[alias] = bucket
         fields = ("alias", "s3_bucket_name")
-        self.db.insert("s3", fields, data)
+        self.db.insert("aliases", fields, list(buckets.items()), del_table=True)
+        self.db.execute("""
+        insert or ignore into aliases (alias)
+        select distinct cb_alias from installations where cb_alias is not null;
+        """)
 
-    def get_activity(self):
+    def get_activity(self, xlsx_files):
         data = []
         for f in xlsx_files:
             wb = openpyxl.load_workbook(f, data_only=True)
@@ -339,23 +463,54 @@ class report_data(object):
                     continue
                 act_date = datetime.strftime(act_date, "%Y-%m-%d")
                 data.append([account, act_date])
-        fields = ["acct_id", "activity_date"]
-        self.db.insert("cse_activity", fields, data)
+        self.load_activity(data)
 
-def table_creations():
-    db = sqlite_db("onprem_products.db")
-    for table in ("installations", "accounts", "opportunities", "subscriptions",\
-                  "cse_activity", "ctas", "inst_summary", "acct_summary", "s3"):
+    def load_activity(self, data):
+        # data is [account name, activity date], names are resolved to acct_id once here so the summaries
+        # join on acct_id. Unmatched rows are kept with a null acct_id.
+        resolved = resolve_names(self.db, [i[0] for i in data])
+        rows = []
+        for account, act_date in data:
+            for acct_id in resolved.get(account, [None]):
+                rows.append([acct_id, account, act_date])
+        fields = ["acct_id", "account_name", "activity_date"]
+        self.db.insert("cse_activity", fields, rows)
+
+def table_creations(db_file="onprem_products.db"):
+    db = sqlite_db(db_file)
+    for table in ("installations", "accounts", "opportunities", "next_renewal", "subscriptions",\
+                  "cse_activity", "ctas", "inst_summary", "acct_summary", "s3", "aliases", "product_codes",\
+                  "acct_metrics", "acct_cta_metrics", "acct_metrics_dirty"):
         db.execute(f"drop table if exists {table};")
 
-    # CSE Timeline Activities
+    # CSE Timeline Activities, account_name is the spreadsheet name and acct_id what it resolved to
     query = """
     CREATE table cse_activity(
     acct_id TEXT,
+    account_name TEXT,
     activity_date TEXT
     );
     """
     db.execute(query)
+    db.execute("CREATE INDEX cse_activity_acct on cse_activity(acct_id, activity_date);")
+
+    # Spreadsheet account name -> acct_id matches, not dropped above so they carry over between runs.
+    # acct_id is '' for a name that matched nothing, accounts_version is the account master it was resolved against
+    columns = [i[1] for i in db.execute("pragma table_info(account_name_map);")]
+    if columns and "accounts_version" not in columns:
+        db.execute("drop table account_name_map;")
+    query = """
+    CREATE TABLE IF NOT EXISTS account_name_map (
+    name TEXT,
+    acct_id TEXT,
+    name_key TEXT,
+    method TEXT,
+    accounts_version TEXT,
+    PRIMARY KEY (name, acct_id)
+    ) WITHOUT ROWID;
+    """
+    db.execute(query)
+    db.execute("CREATE INDEX IF NOT EXISTS account_name_map_key on account_name_map(name_key);")
 
     # Installations
     query = """
@@ -364,11 +519,11 @@ def table_creations():
     licenses_purchased INTEGER DEFAULT Null CHECK (typeof(licenses_purchased) in ('integer', Null)),
     normalized_host_count INTEGER DEFAULT Null CHECK (typeof(normalized_host_count) in ('integer', Null)),
     deployment TEXT DEFAULT Null,
-    last_contact STRING,
-    acct_id STRING,
-    product STRING,
+    last_contact TEXT,
+    acct_id TEXT,
+    product TEXT,
     air_gapped INTEGER DEFAULT Null CHECK (typeof(air_gapped) in ('integer', Null)),
-    sid STRING DEFAULT Null,
+    sid TEXT DEFAULT Null,
     le INTEGER DEFAULT 0 CHECK (typeof(le) in ('integer', Null)),
     le_perc TEXT DEFAULT NULL,
     me INTEGER DEFAULT 0 CHECK (typeof(me) in ('integer', Null)),
@@ -417,6 +572,23 @@ def table_creations():
     );
     """
     db.execute(query)
+    db.execute("CREATE INDEX opportunities_acct on opportunities(acct_id);")
+
+    # Next renewal per account and product, filled instead of opportunities in next_renewal mode
+    query = """
+    CREATE table next_renewal(
+    acct_id TEXT,
+    product TEXT,
+    opp_id TEXT,
+    acv INTEGER CHECK (typeof(acv) in ('integer', Null)),
+    forecast TEXT,
+    close_date TEXT,
+    renewal_qt TEXT,
+    opp_count INTEGER DEFAULT 0 CHECK (typeof(opp_count) in ('integer', Null)),
+    PRIMARY KEY (product, acct_id)
+    );
+    """
+    db.execute(query)
 
     # Subscriptions
     query = """
@@ -447,13 +619,13 @@ def table_creations():
     db.execute(query)
 
     # Installation Summary
-    query = """
+    query = f"""
     CREATE table inst_summary (
     inst_id TEXT,
     sid TEXT,
     licenses_purchased INTEGER DEFAULT 0 CHECK (typeof(licenses_purchased) in ('integer', Null)),
     normalized_host_count INTEGER DEFAULT 0 CHECK (typeof(normalized_host_count) in ('integer', Null)),
-    deployment REAL DEFAULT 0 CHECK (typeof(deployment) in ('REAL', Null)),
+    deployment TEXT DEFAULT Null,
     le INTEGER DEFAULT 0 CHECK (typeof(le) in ('integer', Null)),
     le_perc TEXT DEFAULT NULL,
     me INTEGER DEFAULT 0 CHECK (typeof(me) in ('integer', Null)),
@@ -480,9 +652,7 @@ def table_creations():
     opp_acv INTEGER DEFAULT 0 CHECK (typeof(opp_acv) in ('integer', Null)),
     opp_count INTEGER DEFAULT 0 CHECK (typeof(opp_count) in ('integer', Null)),
     sub_product_arr INTEGER DEFAULT 0 CHECK (typeof(sub_product_arr) in ('integer', Null)),
-    product_usage_analytics TEXT,
-    tech_assessment TEXT,
-    csa_whiteboarding TEXT,
+    {CTA_DDL}
     last_timeline TEXT,
     account_manager TEXT,
     vmw_geo TEXT,
@@ -493,9 +663,11 @@ def table_creations():
     cs_partner TEXT DEFAULT NULL);
     """
     db.execute(query)
+    # Per product reads ordered by account, for the report sheets and the report server
+    db.execute("CREATE INDEX inst_summary_product on inst_summary(product, account_name);")
 
     # account summary
-    query = """
+    query = f"""
     CREATE TABLE acct_summary (
     acct_id TEXT,
     tier TEXT,
@@ -510,9 +682,7 @@ def table_creations():
     cse TEXT,
     product TEXT,
     last_timeline TEXT,
-    product_usage_analytics TEXT,
-    tech_assessment TEXT,
-    csa_whiteboarding TEXT,
+    {CTA_DDL}
     connected_count INTEGER DEFAULT 0 CHECK (typeof(connected_count) in ('integer', Null)),
     disconnected_count INTEGER DEFAULT 0 CHECK (typeof(disconnected_count) in ('integer', Null)),
     renewal_date TEXT,
@@ -539,14 +709,97 @@ def table_creations():
     s3_bucket INTEGER DEFAULT 0);
     """
     db.execute(query)
+    db.execute("CREATE INDEX acct_summary_product on acct_summary(product, account_name);")
 
-    # S3 buckets
+    # Product code per opportunity/subscription/installation row
     query = """
-    CREATE TABLE s3 (
-        alias TEXT DEFAULT NULL,
-        s3_bucket_name TEXT DEFAULT NULL);
+    CREATE TABLE product_codes (
+    source TEXT,
+    row_id TEXT,
+    acct_id TEXT,
+    product_code TEXT,
+    PRIMARY KEY (source, row_id, product_code)
+    );
     """
     db.execute(query)
+    db.execute("CREATE INDEX product_codes_code on product_codes(source, product_code, acct_id, row_id);")
+    db.execute("CREATE INDEX product_codes_acct on product_codes(acct_id, source, product_code);")
+
+    # Normalised Carbon Black aliases (alias_key) from installations and the S3 bucket list
+    query = """
+    CREATE TABLE aliases (
+        alias TEXT PRIMARY KEY,
+        s3_bucket_name TEXT DEFAULT NULL
+    ) WITHOUT ROWID;
+    """
+    db.execute(query)
+    db.execute("CREATE INDEX installations_alias on installations(cb_alias);")
+
+    # Account metrics per product, kept current by refresh_metrics from the accounts marked dirty below
+    query = """
+    CREATE TABLE acct_metrics (
+    acct_id TEXT,
+    product TEXT,
+    last_timeline TEXT,
+    connected_count INTEGER,
+    disconnected_count INTEGER,
+    licenses_purchased INTEGER,
+    product_acv REAL,
+    sub_deployment_perc REAL,
+    inst_deployment_perc REAL,
+    le INTEGER,
+    le_perc REAL,
+    me INTEGER,
+    me_perc REAL,
+    he INTEGER,
+    he_perc REAL,
+    PRIMARY KEY (acct_id, product)
+    ) WITHOUT ROWID;
+    """
+    db.execute(query)
+    db.execute("CREATE INDEX acct_metrics_product on acct_metrics(product);")
+
+    query = """
+    CREATE TABLE acct_cta_metrics (
+    acct_id TEXT,
+    cta_type TEXT,
+    closed_date TEXT,
+    PRIMARY KEY (acct_id, cta_type)
+    ) WITHOUT ROWID;
+    """
+    db.execute(query)
+    db.execute("CREATE INDEX acct_cta_metrics_type on acct_cta_metrics(cta_type, acct_id);")
+
+    query = """
+    CREATE TABLE acct_metrics_dirty (
+    acct_id TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+    """
+    db.execute(query)
+
+    # Lookups by account so a refresh only reads the rows of the changed accounts
+    db.execute("CREATE INDEX installations_acct on installations(acct_id);")
+    db.execute("CREATE INDEX subscriptions_acct on subscriptions(acct_id);")
+    db.execute("CREATE INDEX ctas_acct on ctas(acct_id);")
+
+    # Source table -> columns whose changes affect acct_metrics
+    dirty_columns = {
+        "installations": "acct_id, product, normalized_host_count, licenses_purchased, air_gapped, le, me, he",
+        "subscriptions": "acct_id, product, quantity, arr",
+        "ctas": "acct_id, cta_type, closed_date, status",
+        "cse_activity": "acct_id, activity_date",
+        "accounts": "acct_id"
+    }
+    for table, columns in dirty_columns.items():
+        for event, ref in (("INSERT", "new"), ("DELETE", "old"), (f"UPDATE OF {columns}", "new"), (f"UPDATE OF {columns}", "old")):
+            name = f"{table}_{ref}_{event.split()[0].lower()}_dirty"
+            db.execute(f"""
+            CREATE TRIGGER {name} AFTER {event} ON {table}
+            WHEN {ref}.acct_id IS NOT NULL
+            BEGIN
+                INSERT OR IGNORE INTO acct_metrics_dirty VALUES ({ref}.acct_id);
+            END;
+            """)
 
 def writerows(wb, sheet, data, linkBool=False, setwid=True, col1url=False, bolder=False):
     bold = wb.add_format({"bold": True})
@@ -601,485 +854,522 @@ def writerows(wb, sheet, data, linkBool=False, setwid=True, col1url=False, bolde
             sheet.write_url(0, 6, "internal:Master!A1", string="Mastersheet")
     return True
 
-def create_inst_master(db, prod):
-    def add_metric(data_dict, new_data):
-        new_keys = []
-        for row in new_data:
-            row_tup = list(zip(row.keys(), [i for i in row]))
-            for i in row.keys(): new_keys.append(i)
-            inst_id = row_tup.pop(0)[1]
-            data_dict[inst_id].update(dict(row_tup))
-        for inst_id in data_dict:
-            for key in set(new_keys):
-                if key not in data_dict[inst_id]:
-                    # inst_id is the first level key, we dont need it in the value keys too
-                    if key == "inst_id": continue
-                    data_dict[inst_id][key] = None
-        return data_dict
-
-    rows = defaultdict(dict)
-
-    # All of installations
-    data = db.execute_dict(f"select * from installations where product = '{prod}';")
-    add_metric(rows, data)
-
-    # All of accounts
-    query = f"""
-    select i.inst_id, a.*
-    from installations i
-    left join accounts a on i.acct_id = a.acct_id
-    where i.product = '{prod}';
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
-
-    # Those opportunities that apply *CBLO can be multiple so its omitted + wtf is other?
-    # Provides metrics related only to the next renewal for the product in question
-    lookup = {
-        "Cb Cloud": ["CBWL", "CBVM", "CBWS", "CBD", "CBCO", "CBTS", "CBTH"],
-        "Cb Response Cloud": ["CBRC"],
-        "Cb Protection": ["CBP"],
-        "Cb Response": ["CBR"]
-    }
-    query = f"""
-    select i.inst_id,
-    o.close_date,
-    o.renewal_qt,
-    o.forecast,
-    o.acv as opp_acv,
-    count(*) as opp_count
-    from installations i
-    left join opportunities o on i.acct_id = o.acct_id
-    inner join
-        (select opp_id,
-        min(close_date) cd
-        from opportunities
-        group by opp_id ) o2
-        on o.opp_id = o2.opp_id and o.close_date = o2.cd
-    where i.product = '{prod}'
-    and o.type like '%{", ".join(lookup[prod])}%'
-    group by i.inst_id
-    order by o.close_date desc;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def inst_summary_rows(db, prod, next_renewal=False):
+    params = summary_params(prod, catalog.renewal_codes(prod))
+    return run_summary(db, summary_table("inst_id"), "inst", params, next_renewal, CTA_TYPES)
 
-    # Arr from just the product in question
-    query = f"""
-    select i.inst_id,
-    round(sum(s.arr), 2) sub_product_arr
-    from installations i
-    left join subscriptions s on i.acct_id = s.acct_id and i.product = s.product
-    where 1=1
-    and i.product = '{prod}'
-    group by i.inst_id
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def acct_summary_rows(db, prod, next_renewal=False):
+    params = summary_params(prod, catalog.renewal_codes(prod))
+    # Seed table with just the accounts that have the product in question
+    data = [i[0] for i in db.execute(QUERIES["acct_seed"], params)]
+    rows = summary_table("acct_id", data, grow=False)
+    return run_summary(db, rows, "acct", params, next_renewal, CTA_TYPES)
 
-    # CTAs from gainsight
-    for cta in ("Product Usage Analytics", "Tech Assessment", "CSA Whiteboarding"):
-        query = f"""
-        select i.inst_id,
-        max(c.closed_date) as '{cta.lower().replace(" ", "_")}'
-        from installations i
-        left join ctas c on i.acct_id = c.acct_id
-        where c.cta_type = '{cta}'
-        and c.status = 'Closed'
-        and i.product = '{prod}'
-        group by i.inst_id
-        """
-        data = db.execute_dict(query)
-        add_metric(rows, data)
+def create_inst_master(db, prod, next_renewal=False):
+    rows = inst_summary_rows(db, prod, next_renewal)
+    fields = ["inst_id"] + rows.fields
+    rows = rows.rows()
+    db.insert("inst_summary", fields, rows)
+    return rows
 
-    # CSE Timeline activities
-    query = f"""
-    select i.inst_id,
-    max(cse.activity_date) as 'last_timeline'
-    from installations i
-    left join accounts a on i.acct_id = a.acct_id
-    left join cse_activity cse on a.account_name = cse.acct_id
-    where i.product = '{prod}'
-    group by i.inst_id
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def create_acct_master(db, prod, next_renewal=False):
+    refresh_metrics(db)
+    rows = acct_summary_rows(db, prod, next_renewal)
+    fields = ["acct_id"] + rows.fields
+    db.insert("acct_summary", fields, rows.rows())
 
-    fields = ["inst_id"] + list(rows[list(rows)[0]].keys())
-    rows = [[inst_id] + list(rows[inst_id].values()) for inst_id in rows]
-    db.insert("inst_summary", fields, rows)
+def summary_shard(db_file, prod, next_renewal, shard, shards):
+    # Runs in a worker process on a read-only connection, returns both summaries for one shard of accounts
+    db = sqlite_db(db_file, read_only=True)
+    shard_tables(db, shard, shards)
+    acct = acct_summary_rows(db, prod, next_renewal)
+    inst = inst_summary_rows(db, prod, next_renewal)
+    db.connection.close()
+    return (acct.fields, acct.rows()), (inst.fields, inst.rows())
+
+def create_summaries(db, prod, next_renewal=False, shards=1, max_workers=None, memory_mb=None):
+    # shards > 1 hash-partitions the accounts and computes each shard in its own process, the partial
+    # summaries are merged here and written through the one writable connection
+    if shards <= 1:
+        create_acct_master(db, prod, next_renewal)
+        return create_inst_master(db, prod, next_renewal)
+
+    # Workers are read-only, pending metric changes are applied first
+    refresh_metrics(db)
+    acct, inst = summary_table("acct_id"), summary_table("inst_id")
+    max_workers = min(max_workers or os.cpu_count() or 1, shards)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_memory, initargs=(memory_mb,)) as pool:
+        futures = [pool.submit(traced, summary_shard, db.db_file, prod, next_renewal, x, shards) for x in range(shards)]
+        with progress.stage(f"summary shards {prod}", total=shards, unit="shards") as stage:
+            for f in as_completed(futures):
+                (acct_fields, acct_rows), (inst_fields, inst_rows) = merged(f)
+                acct.add(["acct_id"] + acct_fields, acct_rows)
+                inst.add(["inst_id"] + inst_fields, inst_rows)
+                stage.update()
+
+    db.insert("acct_summary", ["acct_id"] + acct.fields, acct.rows())
+    rows = inst.rows()
+    db.insert("inst_summary", ["inst_id"] + inst.fields, rows)
     return rows
 
-def create_acct_master(db, prod):
-    def add_metric(data_dict, new_data):
-        new_keys = []
-        for row in new_data:
-            row_tup = list(zip(row.keys(), [i for i in row]))
-            for i in row.keys(): new_keys.append(i)
-            acct_id = row_tup.pop(0)[1]
-            if acct_id not in data_dict: continue
-            data_dict[acct_id].update(dict(row_tup))
-        for acct_id in data_dict:
-            for key in set(new_keys):
-                if key not in data_dict[acct_id]:
-                    # acct_id is the first level key, we dont need it in the value keys too
-                    if key == "acct_id": continue
-                    data_dict[acct_id][key] = None
-        return data_dict
+ACCOUNT_COLUMNS = f"""
+account_name as "Account",
+products as "Products Owned",
+renewal_date as "Next Renewal",
+renewal_qt as "Renewal Qt",
+forecast as "Renwewal Forecast",
+tier as "Tier",
+--monitoring_partner || ", " || cs_partner as "Partner",
+cs_partner as "Partner",
+csm as "CSM",
+csm_manager as "CSM Manager",
+cse as "CSE",
+account_manager as "Account Manager",
+vmw_geo as "VMW Geo",
+vmw_sub_div as "VMW Sub-division",
+vmw_country as "VMW Country",
+arr as "ARR",
+product_acv as "Product ACV",
+csm_score as "CSM Score",
+gs_score as "GS Score",
+csm_comments as "CSM Comments",
+adoption_comments as "Adoption Comments",
+last_timeline as "Latest CSE Activity",
+{CTA_REPORT_COLUMNS}
+connected_count as "Normalized Endpoints",
+disconnected_count as "Disconnected Endpoints",
+licenses_purchased as "Licenses",
+le as "LE Count",
+le_perc as "LE Perc",
+me as "ME Count",
+me_perc as "ME Perc",
+he as "HE Count",
+he_perc as "HE Perc",
+sub_deployment_perc as "Deployment(Sub)",
+inst_deployment_perc as "Deployment(Inst)",
+s3_bucket as "Have S3 Bucket",
+acct_id as "Account ID"
+"""
 
-    # Seed table with just the accounts that have the product in question
-    data = [i[0] for i in db.execute(f"select acct_id from installations where product = '{prod}';")]
-    rows = {i:{} for i in data}
+ACCOUNT_QUERY = f"""
+select
+{ACCOUNT_COLUMNS}
+from acct_summary
+where product = ?
+order by account_name;
+"""
 
-    # All of accounts table
-    data = db.execute_dict(f'select *, "{prod}" as product from accounts;')
-    add_metric(rows, data)
+INSTALLATION_COLUMNS = f"""
+account_name as "Account",
+close_date as "Next Renewal",
+renewal_qt as "Renewal Qt",
+forecast as "Renwewal Forecast",
+opp_count as "Renewal Opps",
+tier as "Tier",
+csm as "CSM",
+csm_manager as "CSM Manager",
+cse as "CSE",
+arr as "ARR",
+sub_product_arr as "ARR(Sub)",
+opp_acv as "Product ACV",
+csm_score as "CSM Score",
+gs_score as "GS Score",
+csm_comments as "CSM Comments",
+adoption_comments as "Adoption Comments",
+last_timeline as "Latest CSE Activity",
+{CTA_REPORT_COLUMNS}
+licenses_purchased as "Licenses",
+le as "LE Count",
+le_perc as "LE Perc",
+me as "ME Count",
+me_perc as "ME Perc",
+he as "HE Count",
+he_perc as "HE Perc",
+normalized_host_count as "Normalized Endpoints",
+deployment as "Deployment",
+last_contact as "Last Contact",
+air_gapped as "Connected",
+inst_id as "Installation ID",
+sid as "SID",
+acct_id as "Account ID"
+"""
 
-    # CSE Timeline activities
-    query = """
-    select a.acct_id,
-    max(cse.activity_date) as 'last_timeline'
-    from accounts a
-    left join cse_activity cse on a.account_name = cse.acct_id
-    group by a.acct_id;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+INSTALLATION_QUERY = f"""
+select
+{INSTALLATION_COLUMNS}
+from inst_summary
+where product = ?
+order by account_name;
+"""
 
-    # Ctas
-    for cta in ("Product Usage Analytics", "Tech Assessment", "CSA Whiteboarding"):
-        query = f"""
-        select a.acct_id,
-        max(c.closed_date) as '{cta.lower().replace(" ", "_")}'
-        from accounts a
-        left join ctas c on a.acct_id = c.acct_id
-        where c.cta_type = '{cta}'
-        and c.status = 'Closed'
-        group by a.acct_id;
-        """
-        data = db.execute_dict(query)
-        add_metric(rows, data)
+REPORT_SHEETS = {"Accounts": ACCOUNT_QUERY, "Installations": INSTALLATION_QUERY}
+# Sheet -> summary table and columns, for the sliced reports
+SHEET_COLUMNS = {"Accounts": ("acct_summary", ACCOUNT_COLUMNS), "Installations": ("inst_summary", INSTALLATION_COLUMNS)}
 
-    # Deployment info from installations
-    query = f"""
-    select a.acct_id,
-    sum(case when i.air_gapped = 0 then i.normalized_host_count end) as connected_count,
-    sum(case when i.air_gapped = 1 then i.normalized_host_count end) as disconnected_count,
-    group_concat(distinct i.monitoring_partner) as monitoring_partner,
-    group_concat(distinct i.cb_alias) as cb_alias
-    from accounts a
-    left join installations i on a.acct_id = i.acct_id
-    where i.product = '{prod}'
-    group by a.acct_id;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def sheet_data(db, query, product):
+    header, data = db.execute_columns(query, (product,))
+    return drop_empty(header, data)
 
-    # s3
-    query = f"""
-    select a.acct_id,
-    case when s3.alias is Null then 0 else 1 end as s3_bucket
-    from accounts a
-    left join installations i on a.acct_id = i.acct_id
-    left join s3 on i.cb_alias = s3.alias
-    where i.product = '{prod}'
-    group by a.acct_id;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
-    print(query)
+def drop_empty(header, data):
+    # Clean up data that doesnt apply to the product
+    # Find the columns that are all empty and drop them from the data and header
+    filled = [False] * len(header)
+    for row in data:
+        for x, i in enumerate(row):
+            if i: filled[x] = True
+    keep = [x for x, i in enumerate(filled) if i]
+    if not keep:
+        return []
+    data = [[row[x] for x in keep] for row in data]
+    data.insert(0, [header[x] for x in keep])
+    return data
 
-    # Opportunities
-    lookup = {
-        "Cb Cloud": ["CBWL", "CBVM", "CBWS", "CBD", "CBCO", "CBTS", "CBTH", "Endpoint STD", "EEDR", "Endpoint"],
-        "Cb Response Cloud": ["Hosted EDR"],
-        "Cb Protection": ["CBP", "Application Control"],
-        "Cb Response": ["CBR"]
-    }
-    query = f"""
-    select a.acct_id,
-    group_concat(o.close_date) as renewal_date,
-    group_concat(o.renewal_qt) as renewal_qt,
-    group_concat(o.forecast) as forecast --,
-    --sum(o.acv) as product_acv
-    from accounts a
-    left join opportunities o on a.acct_id = o.acct_id
-    where o.type like '%{"%, %".join(lookup[prod])}%'
-    group by a.acct_id;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def fetch_sheets(db, product, sheets=REPORT_SHEETS):
+    # {sheet: (header, rows)}, fetched once and shared by the fingerprint and the workbook
+    return {name: db.execute_columns(REPORT_SHEETS[name], (product,)) for name in sheets}
 
-    # purchased licenses from subscriptions
-    query = f"""
-    select acct_id,
-    sum(quantity) as licenses_purchased,
-    sum(arr) as product_acv
-    from subscriptions
-    where product = '{prod}'
-    group by acct_id;
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+def write_report(db, product, path=None, sheets=REPORT_SHEETS, constant_memory=False, fetched=None):
+    # fetched is fetch_sheets' result when the rows are already at hand, otherwise each sheet is queried here
+    path = path or f"Consumption Report_{product}.xlsx"
+    # constant_memory flushes each row as it is written, which writerows allows since it goes row by row
+    wb = xlsxwriter.Workbook(path, {"constant_memory": constant_memory})
 
-    # Calculated fields
-    # Deployment percentage from subscriptions
-    query = f"""
-    select hc.acct_id,
-    round(cast(nhc as real) / quan * 100, 2) as sub_deployment_perc
-    from (
-        select i.acct_id,
-        sum(i.normalized_host_count) nhc
-        from installations i
-        where i.product = '{prod}'
-        and i.air_gapped = 0
-        group by i.acct_id) as hc
-    join (
-        select s.acct_id,
-        sum(s.quantity) quan
-        from subscriptions s
-        where s.product = '{prod}'
-        group by s.acct_id) as ss on hc.acct_id = ss.acct_id
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+    # Account Level, then Installation Level
+    for name in sheets:
+        sheet = wb.add_worksheet(name)
+        data = drop_empty(*fetched[name]) if fetched else sheet_data(db, REPORT_SHEETS[name], product)
+        if data:
+            writerows(wb, sheet, data)
 
-    # Deployment percentage by getting max from installation records
-    query = f"""
-    select hc.acct_id,
-    round(cast(nhc as real) / quan * 100, 2) as inst_deployment_perc
-    from (
-        select i.acct_id,
-        sum(i.normalized_host_count) nhc
-        from installations i
-        where i.product = '{prod}'
-        group by i.acct_id) as hc
-    join (
-        select i.acct_id,
-        max(i.licenses_purchased) quan
-        from installations i
-        where i.product = '{prod}'
-        group by i.acct_id) as ss on hc.acct_id = ss.acct_id
-    """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
+    wb.close()
+    return path
 
-    # Enforcement Levels
-    query = f"""
-    select i.acct_id,
-    sum(i.le) as le,
-    round(cast(sum(i.le) as real) / max(i.licenses_purchased) * 100, 2) as le_perc,
-    sum(i.me) as me,
-    round(cast(sum(i.me) as real) / max(i.licenses_purchased) * 100, 2) as me_perc,
-    sum(i.he) as he,
-    round(cast(sum(i.he) as real) / max(i.licenses_purchased) * 100, 2) as he_perc
-    from installations i
-    where i.product = '{prod}'
-    and i.air_gapped = 0
-    group by i.acct_id;
+def limit_memory(memory_mb):
+    if not memory_mb or resource is None:
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+# Fingerprints of the last published workbooks, kept next to them, so a run with no new data writes nothing
+FINGERPRINT_FILE = "report_fingerprints.json"
+
+def report_fingerprint(db, product, sheets=REPORT_SHEETS, fetched=None):
+    # Order independent hash of the rows each sheet would get, the header included so a column change counts.
+    # Row hashes are summed rather than xored so duplicate rows don't cancel out.
+    fetched = fetched or fetch_sheets(db, product, sheets)
+    total, rows = 0, 0
+    for name in sheets:
+        header, data = fetched[name]
+        for row in [[name] + header] + [[name] + list(i) for i in data]:
+            digest = hashlib.blake2b(json.dumps(row, default=str).encode(), digest_size=16).digest()
+            total = (total + int.from_bytes(digest, "big")) % (1 << 128)
+        rows += len(data)
+    return f"{total:032x}", rows
+
+def load_fingerprints(path=FINGERPRINT_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_fingerprints(fingerprints, path=FINGERPRINT_FILE):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def report_path(product, sheets=None):
+    if sheets is None:
+        return f"Consumption Report_{product}.xlsx"
+    return f"Consumption Report_{product}_{'_'.join(sheets)}.xlsx"
+
+def render_report(db_file, product, sheets=None, published=None):
+    # Runs in a worker process with its own read-only connection. published is the fingerprint the existing
+    # workbook was written from, the workbook is left alone when it still matches.
+    # Returns (path, fingerprint, rows, written)
+    db = sqlite_db(db_file, read_only=True)
+    path = report_path(product, sheets)
+    sheets = sheets or REPORT_SHEETS
+    # Each sheet query runs once, the workbook is written from the rows the fingerprint was taken over
+    fetched = fetch_sheets(db, product, sheets)
+    fingerprint, rows = report_fingerprint(db, product, sheets, fetched)
+    if fingerprint == published and os.path.exists(path):
+        return path, fingerprint, rows, False
+    write_report(db, product, path, sheets, constant_memory=True, fetched=fetched)
+    return path, fingerprint, rows, True
+
+def render_reports(db_file, products, split_sheets=False, max_workers=None, memory_mb=None, force=False,
+                   fingerprint_file=FINGERPRINT_FILE):
+    # One workbook per product, or one file per product and sheet when split_sheets is set. Workbooks whose
+    # fingerprint matches report_fingerprints.json are skipped unless force is set.
+    if split_sheets:
+        jobs = [(product, [sheet]) for product in products for sheet in REPORT_SHEETS]
+    else:
+        jobs = [(product, None) for product in products]
+    if not jobs:
+        return []
+    fingerprints = load_fingerprints(fingerprint_file)
+    published = {} if force else {path: i["fingerprint"] for path, i in fingerprints.items()}
+    max_workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_memory, initargs=(memory_mb,)) as pool:
+        futures = [pool.submit(traced, render_report, db_file, product, sheets, published.get(report_path(product, sheets)))
+                   for product, sheets in jobs]
+        with progress.stage("render reports", total=len(futures), unit="files") as stage:
+            for f in as_completed(futures):
+                stage.update()
+        results = [merged(f) for f in futures]
+
+    checked = datetime.now().isoformat(timespec="seconds")
+    for (product, sheets), (path, fingerprint, rows, written) in zip(jobs, results):
+        entry = fingerprints.get(path, {})
+        if written:
+            entry = {"product": product, "fingerprint": fingerprint, "rows": rows, "published": checked}
+        entry["checked"] = checked
+        fingerprints[path] = entry
+        logger.info(f"render_reports {path} {'written' if written else 'unchanged'} fingerprint {fingerprint} rows {rows}")
+    save_fingerprints(fingerprints, fingerprint_file)
+    return [i[0] for i in results]
+
+# Summary columns a report can be sliced by, one workbook per distinct value
+SLICE_COLUMNS = ("csm", "csm_manager", "vmw_geo")
+
+def slice_query(name, column, sharded=False):
+    # Ordered by the slice value so each slice is a contiguous run of rows, empty values form one slice
+    table, columns = SHEET_COLUMNS[name]
+    shard = "and acct_shard(coalesce({column}, ''), :shards) = :shard" if sharded else ""
+    return f"""
+    select coalesce({column}, '') as slice,
+    {columns}
+    from {table}
+    where product = :product
+    {shard.format(column=column)}
+    order by slice, account_name;
     """
-    data = db.execute_dict(query)
-    add_metric(rows, data)
 
-    # Products owned
-    query = f"""
-    select i.acct_id,
-    GROUP_CONCAT(DISTINCT i.product) || "," || group_concat(DISTINCT s.product)
-    from installations i
-    left join subscriptions s on i.acct_id = s.acct_id
-    where i.product = '{prod}'
-    group by i.acct_id
+def merge_groups(groups):
+    # groups is {sheet: iterator of (slice, rows)} each ordered by slice, yields (slice, {sheet: rows}) in order
+    current = {name: next(it, None) for name, it in groups.items()}
+    while any(current.values()):
+        key = min(i[0] for i in current.values() if i)
+        rows = {}
+        for name, item in current.items():
+            if item and item[0] == key:
+                rows[name] = [row[1:] for row in item[1]]
+                current[name] = next(groups[name], None)
+        yield key, rows
+
+def slice_path(product, column, key, out_dir="."):
+    # Keys that had to be changed to make a file name get a hash of the original key, so "A/B" and "A_B",
+    # or an empty csm and one actually named "Unassigned", can't end up writing the same workbook
+    name = re.sub(r"[^\w\- .]", "_", key).strip() or "Unassigned"
+    if name != key:
+        name = f"{name}_{hashlib.md5(key.encode('utf-8')).hexdigest()[:8]}"
+    return os.path.join(out_dir, f"Consumption Report_{product}_{column}_{name}.xlsx")
+
+def write_slices(db, product, column, out_dir=".", shard=0, shards=1, sheets=REPORT_SHEETS):
+    # One ordered cursor per sheet for the whole product, grouped and fanned out to one workbook per slice,
+    # so each slice costs a workbook and not a query. Only the current slice's rows are held in memory.
+    if column not in SLICE_COLUMNS:
+        raise ValueError(f"Can't slice by {column}, expected one of {SLICE_COLUMNS}")
+    db.connection.create_function("acct_shard", 2, acct_shard, deterministic=True)
+    params = {"product": product, "shard": shard, "shards": shards}
+    groups, headers = {}, {}
+    for name in sheets:
+        cur = db.connection.cursor()
+        cur.execute(slice_query(name, column, shards > 1), params)
+        headers[name] = [i[0] for i in cur.description][1:]
+        groups[name] = groupby(cur, key=itemgetter(0))
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for key, rows in merge_groups(groups):
+        path = slice_path(product, column, key, out_dir)
+        wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+        for name in sheets:
+            sheet = wb.add_worksheet(name)
+            data = drop_empty(headers[name], rows.get(name, []))
+            if data:
+                writerows(wb, sheet, data)
+        wb.close()
+        paths.append(path)
+    return paths
+
+def render_slices(db_file, product, column, out_dir=".", shard=0, shards=1):
+    # Runs in a worker process with its own read-only connection
+    db = sqlite_db(db_file, read_only=True)
+    return write_slices(db, product, column, out_dir, shard, shards)
+
+def slice_reports(db_file, product, column, out_dir=".", max_workers=None, memory_mb=None):
+    # Slices are split between workers by the same stable hash as the summary shards, each worker
+    # makes one pass over its share of the slices
+    workers = max(1, max_workers or os.cpu_count() or 1)
+    # Sorted by path either way, a single worker returns them in slice order
+    if workers == 1:
+        return sorted(render_slices(db_file, product, column, out_dir))
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_memory, initargs=(memory_mb,)) as pool:
+        futures = [pool.submit(traced, render_slices, db_file, product, column, out_dir, x, workers) for x in range(workers)]
+        with progress.stage(f"slices {product} by {column}", total=len(futures), unit="workers") as stage:
+            for f in as_completed(futures):
+                stage.update()
+        return sorted([path for f in futures for path in merged(f)])
+
+DRILLDOWN_SECTIONS = {
+    "Installations": """
+    select acct_id, inst_id, sid, licenses_purchased, normalized_host_count, deployment, last_contact,
+    air_gapped, le_perc, me_perc, he_perc
+    from installations
+    where product = ? and acct_id in (select value from json_each(?))
+    order by acct_id, inst_id;
+    """,
+    "Subscriptions": """
+    select acct_id, product, description, quantity, arr, end_date, sub_term
+    from subscriptions
+    where acct_id in (select value from json_each(?2))
+    order by acct_id, end_date;
+    """,
+    "Opportunities": """
+    select acct_id, opp_id, close_date, renewal_qt, forecast, acv, type
+    from opportunities
+    where acct_id in (select value from json_each(?2))
+    union all
+    select acct_id, opp_id, close_date, renewal_qt, forecast, acv, product
+    from next_renewal
+    where acct_id in (select value from json_each(?2))
+    order by acct_id, close_date;
     """
-    data = [list(i) for i in db.execute(query)]
-    replacements = (
-        ("cb protection", "AC"),
-        ("cb response", "EDR"),
-        ("cb response cloud", "HEDR"),
-        ("EDR cloud", "HEDR"),
-        ("cb threathunter", "EEDR"),
-        ("cb defense", "ES"),
-        ("carbon black endpoint standard", "ES"),
-        ("cb liveops", "Live Ops"),
-        ("cb workload", "Workloads"),
-        ("cb threatsight", "ThreatSight"),
-        ("endpoint enterprise", "Endpoint Enterprise"),
-        ("endpoint advanced", "Endpoint Advanced"),
-        ("vmware workspace security", "Workspace Security"),
-        ("carbon black ", "")
-    )
-    for row in data:
-        if not row[1]: continue
-        prods = list(set(row[1].lower().split(",")))
-        for rpl in replacements:
-            prods = [i.replace(rpl[0], rpl[1]) for i in prods]
-            row[1] = ", ".join(prods)
-    for acct_id in rows:
-        rows[acct_id]["products"] = None
-    for acct_id, products in data:
-        if acct_id in rows:
-            rows[acct_id]["products"] = products
-    fields = ["acct_id"] + list(rows[list(rows)[0]].keys())
-    new_rows = []
-    for acct_id in rows:
-        row = [acct_id]
-        fields = ["acct_id"]
-        for key in rows[acct_id]:
-            fields.append(key)
-            row.append(rows[acct_id][key])
-        new_rows.append(row)
-
-    rows = [[acct_id] + list(rows[acct_id].values()) for acct_id in rows]
-    db.insert("acct_summary", fields, new_rows)
-
-def write_report(db, product):
-    lookup = {"Cb Response Cloud": "HEDR", "Cb Protection": "AC", "Cb Response": "EDR"}
-    type_lookup = {"Cb Response Cloud": "cbrc", "Cb Protection": "cbp", "Cb Response": "cbr"}
-    wb = xlsxwriter.Workbook(f"Consumption Report_{product}.xlsx")
-
-    # Account Level
-    sheet = wb.add_worksheet("Accounts")
-    query = f"""
-    select
-    account_name as "Account",
-    products as "Products Owned",
-    renewal_date as "Next Renewal",
-    renewal_qt as "Renewal Qt",
-    forecast as "Renwewal Forecast",
-    tier as "Tier",
-    --monitoring_partner || ", " || cs_partner as "Partner",
-    cs_partner as "Partner",
-    csm as "CSM",
-    csm_manager as "CSM Manager",
-    cse as "CSE",
-    account_manager as "Account Manager",
-    vmw_geo as "VMW Geo",
-    vmw_sub_div as "VMW Sub-division",
-    vmw_country as "VMW Country",
-    arr as "ARR",
-    product_acv as "Product ACV",
-    csm_score as "CSM Score",
-    gs_score as "GS Score",
-    csm_comments as "CSM Comments",
-    adoption_comments as "Adoption Comments",
-    last_timeline as "Latest CSE Activity",
-    product_usage_analytics as "Last CUA",
-    tech_assessment as "Last TA",
-    csa_whiteboarding as "Last WB",
-    connected_count as "Normalized Endpoints",
-    disconnected_count as "Disconnected Endpoints",
-    licenses_purchased as "Licenses",
-    le as "LE Count",
-    le_perc as "LE Perc",
-    me as "ME Count",
-    me_perc as "ME Perc",
-    he as "HE Count",
-    he_perc as "HE Perc",
-    sub_deployment_perc as "Deployment(Sub)",
-    inst_deployment_perc as "Deployment(Inst)",
-    s3_bucket as "Have S3 Bucket",
-    acct_id as "Account ID"
+}
+
+def sheet_name(name):
+    # Excel sheet names can't contain []:*?/\ and quotes break internal links
+    for c in "[]:*?/\\'":
+        name = name.replace(c, "")
+    return name
+
+def render_drilldown(db_file, product, accts, path, max_rows=500):
+    # accts is [(acct_id, account_name), ...] for one workbook, each gets a sheet linked from Master
+    db = sqlite_db(db_file, read_only=True)
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True})
+    master = wb.add_worksheet("Master")
+    names = {acct_id: sheet_name(name or acct_id) for acct_id, name in accts}
+    query = """
+    select acct_id, account_name as "Account", tier as "Tier", csm as "CSM", renewal_date as "Next Renewal",
+    connected_count as "Normalized Endpoints", licenses_purchased as "Licenses",
+    sub_deployment_perc as "Deployment(Sub)"
     from acct_summary
-    where product = '{prod}'
-    order by account_name;
-    """
-    data = db.execute_dict(query)
-    
-    # Clean up data that doesnt apply to the product
-    # Find the columns that are all empty and remove that index from the data and header
-    header = [i for i in data[0].keys()]
-    empties = []
-    for x in range(len(data[0])):
-        col = set([i[x] for i in data])
-        if not any(col):
-            empties.append(x)
-    data = [list(i) for i in data]
-    for x in empties[::-1]:
-        header.pop(x)
-        for xx, i in enumerate(data):
-            data[xx].pop(x)
-    data.insert(0, header)
-    writerows(wb, sheet, data)
-
-    # Installation Level
-    sheet = wb.add_worksheet("Installations")
-    query = f"""
-    select
-    account_name as "Account",
-    close_date as "Next Renewal",
-    renewal_qt as "Renewal Qt",
-    forecast as "Renwewal Forecast",
-    opp_count as "Renewal Opps",
-    tier as "Tier",
-    csm as "CSM",
-    csm_manager as "CSM Manager",
-    cse as "CSE",
-    arr as "ARR",
-    sub_product_arr as "ARR(Sub)",
-    opp_acv as "Product ACV",
-    csm_score as "CSM Score",
-    gs_score as "GS Score",
-    csm_comments as "CSM Comments",
-    adoption_comments as "Adoption Comments",
-    last_timeline as "Latest CSE Activity",
-    product_usage_analytics as "Last CUA",
-    tech_assessment as "Last TA",
-    csa_whiteboarding as "Last WB",
-    licenses_purchased as "Licenses",
-    le as "LE Count",
-    le_perc as "LE Perc",
-    me as "ME Count",
-    me_perc as "ME Perc",
-    he as "HE Count",
-    he_perc as "HE Perc",
-    normalized_host_count as "Normalized Endpoints",
-    deployment as "Deployment",
-    last_contact as "Last Contact",
-    air_gapped as "Connected",
-    inst_id as "Installation ID",
-    sid as "SID",
-    acct_id as "Account ID"
-    from inst_summary
-    where product = '{prod}'
-    order by account_name;
+    where product = ? and acct_id in (select value from json_each(?));
     """
-    data = db.execute_dict(query)
+    # One query for the Master rows and one per section for the whole workbook, split up by account
+    acct_json = json.dumps([i[0] for i in accts])
+    summaries = {row[0]: row[1:] for row in db.execute(query, (product, acct_json))}
+    data = [["Account", "Tier", "CSM", "Next Renewal", "Normalized Endpoints", "Licenses", "Deployment(Sub)"]]
+    for acct_id, name in accts:
+        row = summaries.get(acct_id)
+        data.append([names[acct_id]] + list(row[1:]) if row else [names[acct_id]])
+    writerows(wb, master, data, col1url=True)
 
-    # Clean up data that doesnt apply to the product
-    # Find the columns that are all empty and remove that index from the data and header
-    empties = []
-    for x in range(len(data[0])):
-        col = set([i[x] for i in data])
-        if not any(col):
-            empties.append(x)
-    header = [i for i in data[0].keys()]
-    data = [list(i) for i in data]
-    for x in empties[::-1]:
-        header.pop(x)
-        for xx, i in enumerate(data):
-            data[xx].pop(x)
-    data.insert(0, header)
-    writerows(wb, sheet, data)
+    sections = {}
+    for section, query in DRILLDOWN_SECTIONS.items():
+        fields, rows = db.execute_columns(query, (product, acct_json))
+        grouped = defaultdict(list)
+        for row in rows:
+            grouped[row[0]].append(list(row[1:]))
+        sections[section] = (fields[1:], grouped)
 
+    for x, (acct_id, name) in enumerate(accts):
+        sheet = wb.add_worksheet(f"{x}. {names[acct_id]}"[:31])
+        data = [[name or acct_id], ""]
+        for section, (fields, grouped) in sections.items():
+            rows = grouped.get(acct_id, [])
+            data.append([section] + fields)
+            data += [[""] + i for i in rows[:max_rows]]
+            if len(rows) > max_rows:
+                data.append(["", f"... {len(rows) - max_rows} more"])
+            data.append("")
+        writerows(wb, sheet, data, linkBool=True, bolder=True)
     wb.close()
+    return path
+
+def drilldown_path(product, n):
+    return f"Drilldown_{product}_{n}.xlsx"
+
+def write_drilldown(db_file, product, max_accounts=None, max_rows=500, changed_only=False,
+                    accounts_per_file=200, max_workers=None, memory_mb=None):
+    # Workbooks from an earlier run that wrote more files would otherwise be left next to this run's
+    prefix = drilldown_path(product, "")[:-len(".xlsx")]
+    for path in glob.glob(glob.escape(prefix) + "*.xlsx"):
+        if path[len(prefix):-len(".xlsx")].isdigit():
+            os.remove(path)
+    db = sqlite_db(db_file, read_only=True)
+    accts = db.execute("select acct_id, account_name from acct_summary where product = ? order by account_name;", (product,))
+    if changed_only:
+        # Only accounts with a difference between the last two recorded runs
+        store = history_store()
+        runs = store.runs()
+        previous = store.previous_run(runs[-1]) if runs else None
+        if previous:
+            changed = store.diff(previous, runs[-1])
+            changed.update(store.diff(previous, runs[-1], "inst_summary"))
+            accts = [i for i in accts if i[0] in changed]
+        else:
+            logger.info(f"write_drilldown {product}: no earlier run in history, every account is new")
+    if max_accounts:
+        accts = accts[:max_accounts]
+    if not accts:
+        return []
+
+    # One pass over accts, which is a spill_result when a memory budget is set
+    chunks = list(db.chunks(accts, accounts_per_file))
+    max_workers = min(max_workers or os.cpu_count() or 1, len(chunks))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=limit_memory, initargs=(memory_mb,)) as pool:
+        futures = [pool.submit(traced, render_drilldown, db_file, product, chunk, drilldown_path(product, x + 1), max_rows)
+                   for x, chunk in enumerate(chunks)]
+        with progress.stage(f"drilldown {product}", total=len(futures), unit="files") as stage:
+            for f in as_completed(futures):
+                stage.update()
+        return [merged(f) for f in futures]
 
 if __name__ == "__main__":
-    #for prod in ("Cb Protection", "Cb Response", "Cb Response Cloud"):
+    parser = argparse.ArgumentParser(description="Onprem consumption reports")
+    # Off by default: the account level Next Renewal columns list every renewal opportunity for the product.
+    # With it they hold only the next renewal per account and product, classified by product family.
+    parser.add_argument("--next-renewal", action="store_true", help="report only the next renewal per account")
+    parser.add_argument("--memory-budget", type=float, default=sqlite_connector.MEMORY_BUDGET_MB,
+                        help="MB a result set may hold before it spills to a temp file, ONPREM_MEMORY_BUDGET_MB by default")
+    # One process by default, --shards splits the summaries by account across worker processes
+    parser.add_argument("--shards", type=int, default=1, help="account shards per product summary")
+    parser.add_argument("--workers", type=int, help="worker processes for shards and workbooks, CPU count by default")
+    parser.add_argument("--worker-memory-mb", type=int, help="address space limit per worker process")
+    # Drilldowns are a sheet per account, off by default and best limited to changed accounts or capped
+    parser.add_argument("--drilldown", action="store_true", help="write per account drilldown workbooks")
+    parser.add_argument("--changed-only", action="store_true",
+                        help="drilldown only accounts that changed since the previous recorded run")
+    parser.add_argument("--max-accounts", type=int, help="most accounts per product in the drilldown")
+    args = parser.parse_args()
+    next_renewal = args.next_renewal
+    # Forked workers inherit it
+    sqlite_connector.MEMORY_BUDGET_MB = args.memory_budget
+
     table_creations()
     rd = report_data()
     #rd.get_activity()
-    rd.get_installation_info()
-    rd.get_account_info()
-    rd.get_opportunity_info()
-    rd.get_subscription_info()
-    rd.get_cta_info()
+    asyncio.run(rd.load_async(next_renewal))
     rd.renewal_quarter()
     rd.deployment_percentage()
     rd.enforcement_levels()
     rd.air_gapped()
     rd.get_s3()
     rd.product_family()
-    for prod in ["Cb Response Cloud"]:
-        db = sqlite_db("onprem_products.db")
-        acct_data = create_acct_master(db, prod)
-        inst_data = create_inst_master(db, prod)
-        write_report(db, prod)
+    products = catalog.report_products
+    db = sqlite_db("onprem_products.db")
+    with progress.stage("summaries", total=len(products), unit="products") as stage:
+        for prod in products:
+            create_summaries(db, prod, next_renewal, args.shards, args.workers, args.worker_memory_mb)
+            stage.update()
+    render_reports("onprem_products.db", products, max_workers=args.workers, memory_mb=args.worker_memory_mb)
+    history_store().record_run(db)
+    if args.drilldown:
+        for prod in products:
+            write_drilldown("onprem_products.db", prod, args.max_accounts, changed_only=args.changed_only,
+                            max_workers=args.workers, memory_mb=args.worker_memory_mb)
+    export_snapshots(db)
+    telemetry.report()
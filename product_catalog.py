@@ -0,0 +1,56 @@
+import os
+import re
+import json
+
+# Everything the pipeline knows about products comes from products.json, loaded once per process:
+#   report_products  products that get a consumption report, by the name reports and file names show
+#   products         report/installation product -> installed flag, renewal families and renewal codes
+#   codes            short code -> exact names/family tokens and substrings rewritten to it
+#   strip            substrings dropped from names that match no code
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "products.json")
+
+def sql_list(values):
+    # Literal list for the Trino extracts, which don't take bound parameters
+    return ", ".join("'" + str(i).replace("'", "''") + "'" for i in values)
+
+class product_catalog(object):
+    def __init__(self, path=CATALOG_FILE):
+        with open(path, "r") as f:
+            config = json.load(f)
+        self.report_products = list(config["report_products"])
+        self.products = config["products"]
+        self.installed = [name for name, product in self.products.items() if product.get("installed")]
+
+        # Exact lookups first, then one alternation over every rewrite, longest first so
+        # "cb response cloud" wins over "cb response"
+        self.names = {}
+        self.rewrites = {}
+        for code, entry in config["codes"].items():
+            for name in entry.get("names", []):
+                self.names[name.lower()] = code
+            for text in entry.get("rewrites", []):
+                self.rewrites[text.lower()] = code
+        for text in config.get("strip", []):
+            self.rewrites[text.lower()] = ""
+        self.rewrite = re.compile("|".join(re.escape(i) for i in sorted(self.rewrites, key=len, reverse=True)))
+        self.codes = {}
+
+    def code(self, name):
+        # Short product code for a family token or product name, memoised since the same few names repeat
+        code = self.codes.get(name)
+        if code is None:
+            key = name.strip().lower()
+            code = self.names.get(key)
+            if code is None:
+                code = self.rewrite.sub(lambda m: self.rewrites[m.group(0)], key)
+            self.codes[name] = code
+        return code
+
+    def renewal_codes(self, product):
+        return self.products.get(product, {}).get("renewal_codes", [])
+
+    def renewal_families(self):
+        # report product -> family tokens, for the next renewal classification
+        return {name: p["renewal_families"] for name, p in self.products.items() if p.get("renewal_families")}
+
+catalog = product_catalog()
@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Redraws are capped at RENDER_HZ on a terminal, without one each running stage logs a line every LOG_INTERVAL seconds
+RENDER_HZ = 10
+LOG_INTERVAL = 30
+
+def duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def count(n):
+    for unit, size in (("M", 1000000), ("k", 1000)):
+        if n >= size:
+            return f"{n / size:.1f}{unit}"
+    return str(int(n))
+
+class progress_stage(object):
+    # One unit of work, total is None for streaming sources of unknown length
+    # with progress.stage("insert installations", total=len(data)) as stage: ... stage.update(len(batch))
+    def __init__(self, board, name, total=None, unit="rows"):
+        self.board = board
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.count = 0
+        self.start = time.monotonic()
+        self.end = None
+        self.logged = self.start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.done()
+        return False
+
+    def update(self, n=1):
+        # Called from the hot loops, only the time check happens per call
+        self.count += n
+        self.board.tick()
+
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.count, 0) / rate
+
+    def done(self):
+        if self.end is None:
+            self.end = time.monotonic()
+            self.board.finish(self)
+
+    def status(self):
+        text = f"{self.name} {count(self.count)}"
+        if self.total is not None:
+            text += f"/{count(self.total)}"
+            if self.total:
+                text += f" ({self.count / self.total * 100:.0f}%)"
+        text += f" {self.unit} {count(self.rate())}/s"
+        eta = self.eta()
+        if eta is not None and self.end is None:
+            text += f" ETA {duration(eta)}"
+        elif self.end is not None:
+            text += f" in {duration(self.elapsed())}"
+        return text
+
+    def metrics(self):
+        return {"stage": self.name, "count": self.count, "total": self.total, "unit": self.unit,
+                "seconds": round(self.elapsed(), 3), "rate": round(self.rate(), 1)}
+
+class progress_board(object):
+    # Shared by every stage in the process, concurrent stages are drawn on one status line
+    def __init__(self, stream=None, hz=RENDER_HZ, log_interval=LOG_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = 1.0 / hz
+        self.log_interval = log_interval
+        self.tty = self.stream.isatty() and os.environ.get("TERM") != "dumb"
+        self.lock = threading.Lock()
+        self.active = []
+        self.finished = []
+        self.last = 0.0
+        self.drawn = 0
+
+    def stage(self, name, total=None, unit="rows"):
+        stage = progress_stage(self, name, total, unit)
+        with self.lock:
+            self.active.append(stage)
+        self.tick(force=True)
+        return stage
+
+    def tick(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        with self.lock:
+            self.last = now
+            if self.tty:
+                self.draw(" | ".join(i.status() for i in self.active))
+                return
+            for stage in self.active:
+                if now - stage.logged >= self.log_interval:
+                    stage.logged = now
+                    logger.info(f"progress {stage.status()}")
+
+    def draw(self, line):
+        width = shutil.get_terminal_size((120, 20)).columns - 1
+        line = line[:width]
+        self.stream.write("\r" + line + " " * max(self.drawn - len(line), 0))
+        self.stream.flush()
+        self.drawn = len(line)
+
+    def finish(self, stage):
+        with self.lock:
+            if stage in self.active:
+                self.active.remove(stage)
+            self.finished.append(stage)
+            if self.tty:
+                # The finished stage keeps its own line, the rest carry on below it
+                self.draw(stage.status())
+                self.stream.write("\n")
+                self.drawn = 0
+            self.last = 0.0
+        logger.info(f"progress {stage.status()}")
+        self.tick(force=True)
+
+    def metrics(self):
+        with self.lock:
+            return [i.metrics() for i in self.finished + self.active]
+
+# Shared by the connectors and the report stages for the whole run
+progress = progress_board()
@@ -0,0 +1,209 @@
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import tempfile
+from sqlite_connector import sqlite_db
+from product_catalog import catalog
+from query_telemetry import fingerprint, normalise
+from summary_queries import QUERIES, METRIC_QUERIES, summary_params
+from onprem_report import create_acct_master, create_inst_master, REPORT_SHEETS, DRILLDOWN_SECTIONS, CTA_TYPES
+
+# Captures EXPLAIN QUERY PLAN for the summary, metric and report queries against a benchmark database and
+# compares the flagged steps (full scans of large tables, covering index scans inside a loop, temp b-trees,
+# automatic indexes) with a baseline. Named statements are keyed by name, so editing a query's text still
+# compares it with its baseline, anything else the pipeline runs is keyed by fingerprint.
+# usage: python query_plans.py capture|check [--db bench.db] [--baseline query_plans.json]
+
+BASELINE_FILE = "query_plans.json"
+LARGE_TABLE_ROWS = 10000
+BENCH_INSTALLATIONS = 30000
+PRODUCTS = tuple(catalog.installed)
+
+# Per installation joins that have to stay index lookups whatever the baseline holds, query name -> plan step.
+# An acct_id column without TEXT affinity turns these into a scan per installation.
+REQUIRED_STEPS = {
+    "QUERIES.inst_accounts": "SEARCH a USING INDEX sqlite_autoindex_accounts_1 (acct_id=?)",
+    "QUERIES.inst_sub_arr": "SEARCH s USING INDEX subscriptions_acct (acct_id=?)",
+    "QUERIES.inst_cta": "SEARCH c USING INDEX ctas_acct (acct_id=?)",
+    "QUERIES.inst_timeline": "SEARCH cse USING COVERING INDEX cse_activity_acct (acct_id=?)"
+}
+
+TABLE_REFS = re.compile(r"\b(?:from|join)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?", re.IGNORECASE)
+SQL_WORDS = {"where", "left", "inner", "join", "on", "group", "order", "limit", "union", "cross", "using", "natural"}
+# Bound parameters in a named statement, the traced text has literals in their place
+PARAMS = re.compile(r":\w+|\?\d*")
+
+def copy_database(db_file):
+    # The summary builders write to acct_summary/inst_summary, so they run on a throwaway copy
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    src, dst = sqlite3.connect(db_file), sqlite3.connect(path)
+    src.backup(dst)
+    src.close()
+    dst.close()
+    return path
+
+def named_statements():
+    # name -> (statement, parameters), planned whether or not the pipeline run reaches them
+    product = PRODUCTS[0]
+    params = dict(summary_params(product, catalog.renewal_codes(product)), cta_type=next(iter(CTA_TYPES)))
+    statements = {f"QUERIES.{name}": (query, params) for name, query in QUERIES.items()}
+    statements.update({f"METRIC_QUERIES.{x}": (query, ()) for x, query in enumerate(METRIC_QUERIES)})
+    statements.update({f"REPORT_SHEETS.{name}": (query, (product,)) for name, query in REPORT_SHEETS.items()})
+    statements.update({f"DRILLDOWN_SECTIONS.{name}": (query, (product, "[]"))
+                       for name, query in DRILLDOWN_SECTIONS.items()})
+    return statements
+
+def pipeline_queries(db_file):
+    # Statements the summary builders run besides the named ones, by fingerprint. Inserts, updates and
+    # deletes are kept when they read a table.
+    path = copy_database(db_file)
+    db = sqlite_db(path)
+    queries = {}
+
+    def trace(statement):
+        text = statement.strip()
+        lower = text.lower()
+        if lower.startswith(("select", "with")) or (lower.startswith(("insert", "update", "delete")) and
+                                                     re.search(r"\b(select|where)\b", lower)):
+            queries.setdefault(fingerprint(text), text)
+
+    db.connection.set_trace_callback(trace)
+    for prod in PRODUCTS:
+        for next_renewal in (False, True):
+            db.execute("delete from acct_summary;")
+            db.execute("delete from inst_summary;")
+            create_acct_master(db, prod, next_renewal)
+            create_inst_master(db, prod, next_renewal)
+    db.connection.set_trace_callback(None)
+    named = set([fingerprint(PARAMS.sub("?", query)) for query, _ in named_statements().values()])
+    return db, path, {fp: query for fp, query in queries.items() if fp not in named}
+
+def table_sizes(db):
+    tables = [i[0] for i in db.execute("select name from sqlite_master where type = 'table';")]
+    return {t: db.execute(f"select count(*) from {t};")[0][0] for t in tables}
+
+def inner_loops(rows):
+    # ids of the SCAN/SEARCH steps that run once per row of something else: every loop after the first under
+    # the same parent, and everything below a correlated subquery
+    children, first, correlated = {}, {}, set()
+    for node, parent, _, detail in rows:
+        children[node] = parent
+        if detail.startswith("CORRELATED"):
+            correlated.add(node)
+        elif detail.startswith(("SCAN ", "SEARCH ")):
+            first.setdefault(parent, node)
+    inner = set()
+    for node, parent, _, detail in rows:
+        if not detail.startswith(("SCAN ", "SEARCH ")):
+            continue
+        ancestor = parent
+        while ancestor and ancestor not in correlated:
+            ancestor = children.get(ancestor)
+        if first[parent] != node or ancestor in correlated:
+            inner.add(node)
+    return inner
+
+def plan_flags(query, rows, sizes):
+    # rows are the EXPLAIN QUERY PLAN rows (id, parent, notused, detail)
+    aliases = {}
+    for table, alias in TABLE_REFS.findall(query):
+        if table in sizes:
+            aliases[table] = table
+            if alias and alias.lower() not in SQL_WORDS:
+                aliases[alias] = table
+    inner = inner_loops(rows)
+    flags = []
+    for node, _, _, detail in rows:
+        if detail.startswith("USE TEMP B-TREE"):
+            flags.append(detail)
+        elif "AUTOMATIC" in detail:
+            flags.append(detail)
+        elif detail.startswith("SCAN ") and "COVERING INDEX" in detail:
+            # A whole index per outer row, whatever the table size
+            if node in inner:
+                name = detail.split()[1]
+                flags.append(f"SCAN {aliases.get(name, name)} COVERING INDEX in a loop")
+        elif detail.startswith("SCAN "):
+            name = detail.split()[1]
+            table = aliases.get(name)
+            if table and sizes[table] >= LARGE_TABLE_ROWS:
+                flags.append(f"SCAN {table}")
+    return sorted(set(flags))
+
+def capture(db_file):
+    db, path, queries = pipeline_queries(db_file)
+    try:
+        sizes = table_sizes(db)
+        statements = named_statements()
+        statements.update({fp: (query, ()) for fp, query in queries.items()})
+        plans = {}
+        for key, (query, params) in statements.items():
+            rows = db.execute(f"EXPLAIN QUERY PLAN {query}", params)
+            plans[key] = {"query": normalise(query), "plan": [i[3] for i in rows],
+                          "flags": plan_flags(query, rows, sizes)}
+        return plans
+    finally:
+        db.connection.close()
+        os.remove(path)
+
+def missing_steps(plans):
+    # [(query name, required step, plan)] for each REQUIRED_STEPS query whose plan lacks its step
+    missing = []
+    for name, step in REQUIRED_STEPS.items():
+        plan = plans[name]["plan"]
+        if not any(i.startswith(step) for i in plan):
+            missing.append((name, step, plan))
+    return missing
+
+def compare(baseline, plans):
+    # A regression is a flagged step the baseline didn't have for the same query. A query the baseline doesn't
+    # know, a new named query or an edited unnamed one, is a regression when it has any flagged step.
+    regressions = []
+    for key, current in plans.items():
+        known = baseline.get(key, {}).get("flags", [])
+        added = set(current["flags"]) - set(known)
+        if added:
+            regressions.append((key, current, sorted(added), key in baseline))
+    return regressions
+
+def bench_database(db_file):
+    if db_file:
+        return db_file
+    from synthetic_data import build_database
+    db_file = "bench_products.db"
+    if not os.path.exists(db_file):
+        build_database(db_file, BENCH_INSTALLATIONS)
+    return db_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN capture and regression check")
+    parser.add_argument("command", choices=["capture", "check"])
+    parser.add_argument("--db", help="benchmark database, a synthetic one is built when omitted")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    args = parser.parse_args()
+
+    plans = capture(bench_database(args.db))
+    missing = missing_steps(plans)
+    for name, step, plan in missing:
+        print(f"--REGRESSION-- {name} needs {step}\n    plan {plan}")
+    if args.command == "capture":
+        if missing:
+            print(f"Baseline not written, {len(missing)} required index lookups missing")
+            sys.exit(1)
+        with open(args.baseline, "w") as f:
+            json.dump(plans, f, indent=2, sort_keys=True)
+        flagged = sum(1 for i in plans.values() if i["flags"])
+        print(f"{len(plans)} query plans written to {args.baseline}, {flagged} with flagged steps")
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, plans)
+    for key, current, added, known in regressions:
+        print(f"--REGRESSION-- {key}{'' if known else ' (not in baseline)'} {added}\n    {current['query'][:300]}")
+    print(f"{len(plans)} plans checked, {len(regressions) + len(missing)} regressions")
+    sys.exit(1 if regressions or missing else 0)
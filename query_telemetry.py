@@ -0,0 +1,120 @@
+import re
+import time
+import random
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Fraction of repeat queries whose full text is logged, the first call of each fingerprint always is
+SAMPLE_RATE = 0.01
+TOP_N = 20
+REPORT_FILE = "query_report.txt"
+
+COMMENTS = re.compile(r"--[^\n]*")
+STRINGS = re.compile(r"'(?:[^']|'')*'")
+NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SPACES = re.compile(r"\s+")
+
+def normalise(query):
+    # Literals and IN-lists collapse so the same statement with different values shares a fingerprint
+    query = COMMENTS.sub(" ", query)
+    query = STRINGS.sub("?", query)
+    query = NUMBERS.sub("?", query)
+    query = IN_LISTS.sub("(?)", query)
+    return SPACES.sub(" ", query).strip().lower()
+
+def fingerprint(query):
+    return hashlib.md5(normalise(query).encode()).hexdigest()[:12]
+
+class query_telemetry(object):
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, query, duration, rows=None, calls=1):
+        fp = fingerprint(query)
+        with self.lock:
+            stat = self.stats.get(fp)
+            sample = stat is None or random.random() < self.sample_rate
+            if stat is None:
+                stat = self.stats[fp] = {"query": normalise(query)[:1000], "calls": 0, "total": 0.0, "max": 0.0, "rows": 0}
+            stat["calls"] += calls
+            stat["total"] += duration
+            stat["max"] = max(stat["max"], duration)
+            stat["rows"] += rows or 0
+            count = stat["calls"]
+        logger.info(f"query {fp} {duration * 1000:.1f}ms rows={rows} calls={count}")
+        if sample:
+            logger.info(f"query {fp} text: {query}")
+
+    def drain(self):
+        # Returns the stats recorded so far and starts over
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def merge(self, stats):
+        # Adds stats drained in another process
+        with self.lock:
+            for fp, other in stats.items():
+                stat = self.stats.setdefault(fp, {"query": other["query"], "calls": 0, "total": 0.0, "max": 0.0, "rows": 0})
+                stat["calls"] += other["calls"]
+                stat["total"] += other["total"]
+                stat["max"] = max(stat["max"], other["max"])
+                stat["rows"] += other["rows"]
+
+    def timer(self, query):
+        return query_timer(self, query)
+
+    def top(self, n=TOP_N):
+        with self.lock:
+            stats = [dict(fingerprint=fp, **stat) for fp, stat in self.stats.items()]
+        return sorted(stats, key=lambda i: i["total"], reverse=True)[:n]
+
+    def report(self, n=TOP_N, path=REPORT_FILE):
+        lines = [f"{'fingerprint':12}  {'calls':>7}  {'total s':>9}  {'avg ms':>9}  {'max ms':>9}  {'rows':>10}  query"]
+        for stat in self.top(n):
+            avg = stat["total"] / stat["calls"] * 1000
+            lines.append(f"{stat['fingerprint']:12}  {stat['calls']:>7}  {stat['total']:>9.2f}  {avg:>9.1f}  "
+                         f"{stat['max'] * 1000:>9.1f}  {stat['rows']:>10}  {stat['query'][:200]}")
+        text = "\n".join(lines) + "\n"
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+class query_timer(object):
+    # with telemetry.timer(query) as t: ... t.rows = n
+    def __init__(self, telemetry, query):
+        self.telemetry = telemetry
+        self.query = query
+        self.rows = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.record(self.query, time.perf_counter() - self.start, self.rows)
+        return False
+
+# Shared by the sqlite and tesseract connections for the whole run
+telemetry = query_telemetry()
+
+def traced(func, *args):
+    # Worker process side of a pool task, returns (result, stats) so the parent can merge the queries the
+    # task ran, they'd be lost with the process otherwise. Whatever the process had before, e.g. the
+    # parent's stats copied by fork or an earlier task's, is dropped first so nothing is counted twice.
+    telemetry.drain()
+    result = func(*args)
+    return result, telemetry.drain()
+
+def merged(future):
+    # Parent side, the task's result with its stats added to this process's telemetry
+    result, stats = future.result()
+    telemetry.merge(stats)
+    return result
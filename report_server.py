@@ -0,0 +1,142 @@
+import os
+import json
+import queue
+import hashlib
+import logging
+import argparse
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from sqlite_connector import sqlite_db
+
+logger = logging.getLogger(__name__)
+
+# Read-only JSON endpoint over the summary tables
+# usage: python report_server.py [--db onprem_products.db] [--port 8080]
+#   GET /accounts?product=Cb Response Cloud&csm=Jane Doe&page=2&page_size=50
+#   GET /installations?product=Cb Protection&tier=High&tier=Medium&geo=EMEA
+# Repeating a filter matches any of its values. Locally: python synthetic_data.py 10000 test.db, then --db test.db
+
+DB_FILE = "onprem_products.db"
+POOL_SIZE = 4
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# path -> summary table and the column that breaks ties in the ordering
+RESOURCES = {
+    "/accounts": ("acct_summary", "acct_id"),
+    "/installations": ("inst_summary", "inst_id")
+}
+# query parameter -> summary column
+FILTERS = {"product": "product", "tier": "tier", "csm": "csm", "geo": "vmw_geo"}
+
+class connection_pool(object):
+    # Read-only connections shared by the request threads, each used by one thread at a time
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(sqlite_db(db_file, read_only=True, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        db = self.connections.get()
+        try:
+            yield db
+        finally:
+            self.connections.put(db)
+
+class report_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, db_file=DB_FILE, pool_size=POOL_SIZE):
+        self.db_file = db_file
+        self.pool = connection_pool(db_file, pool_size)
+        super().__init__(address, report_handler)
+
+    def version(self):
+        # Changes whenever the pipeline writes the database, the wal file included
+        parts = []
+        for path in (self.db_file, self.db_file + "-wal"):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        return "|".join(parts)
+
+    def etag(self, path, params):
+        key = json.dumps([self.version(), path, sorted(params.items())])
+        return '"' + hashlib.md5(key.encode()).hexdigest() + '"'
+
+    def rows(self, table, key, params, page, page_size):
+        where, values = [], []
+        for name, column in FILTERS.items():
+            if name in params:
+                where.append(f"{column} in (select value from json_each(?))")
+                values.append(json.dumps(params[name]))
+        where = "where " + " and ".join(where) if where else ""
+        with self.pool.connection() as db:
+            total = db.execute(f"select count(*) from {table} {where};", values)[0][0]
+            fields, data = db.execute_columns(f"""
+            select * from {table} {where}
+            order by account_name, {key}
+            limit ? offset ?;
+            """, values + [page_size, (page - 1) * page_size])
+        return {"total": total, "page": page, "page_size": page_size,
+                "pages": (total + page_size - 1) // page_size, "rows": [dict(zip(fields, i)) for i in data]}
+
+class report_handler(BaseHTTPRequestHandler):
+    server_version = "OnpremReport/1.0"
+
+    def send_json(self, status, body=None, etag=None):
+        data = json.dumps(body, default=str).encode() if body is not None else b""
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            # Clients may keep the response but must revalidate, which is a 304 while the database is unchanged
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in RESOURCES:
+            return self.send_json(404, {"error": f"unknown path {url.path}", "paths": list(RESOURCES)})
+        params = parse_qs(url.query)
+        try:
+            page = int(params.pop("page", [1])[0])
+            page_size = int(params.pop("page_size", [PAGE_SIZE])[0])
+        except ValueError:
+            return self.send_json(400, {"error": "page and page_size must be integers"})
+        if page < 1 or not 0 < page_size <= MAX_PAGE_SIZE:
+            return self.send_json(400, {"error": f"page must be >= 1 and page_size between 1 and {MAX_PAGE_SIZE}"})
+        unknown = set(params) - set(FILTERS)
+        if unknown:
+            return self.send_json(400, {"error": f"unknown filters {sorted(unknown)}", "filters": list(FILTERS)})
+
+        etag = self.server.etag(url.path, dict(params, page=[page], page_size=[page_size]))
+        if etag in [i.strip() for i in self.headers.get("If-None-Match", "").split(",")]:
+            return self.send_json(304, etag=etag)
+        table, key = RESOURCES[url.path]
+        self.send_json(200, self.server.rows(table, key, params, page, page_size), etag)
+
+    def log_message(self, format, *args):
+        logger.info(f"report_server {self.address_string()} {format % args}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only JSON endpoint over acct_summary and inst_summary")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pool", type=int, default=POOL_SIZE, help="read-only connections")
+    args = parser.parse_args()
+
+    server = report_server((args.host, args.port), args.db, args.pool)
+    print(f"Serving {args.db} on http://{args.host}:{args.port} {', '.join(RESOURCES)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
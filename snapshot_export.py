@@ -0,0 +1,132 @@
+import os
+import re
+import hashlib
+import logging
+from datetime import datetime
+from sqlite_connector import sqlite_db, column_converter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = "snapshots"
+SUMMARY_TABLES = ("acct_summary", "inst_summary")
+STAGING_TABLES = ("installations", "accounts", "opportunities", "next_renewal", "subscriptions",
+                  "ctas", "cse_activity", "aliases", "product_codes")
+
+# Arrow type per sqlite_connector column converter, every other column is written as strings. Types come from the
+# declared columns so a column has the same schema in every partition and every run.
+ARROW_TYPES = {"to_integer": "int64", "to_real": "float64"}
+# Hive's name for the partition of rows without a product
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+def table_schema(db, table, fields):
+    columns = db.column_types(table)
+    types = {"int64": pa.int64(), "float64": pa.float64()}
+    schema = []
+    for field in fields:
+        convert = column_converter(*columns.get(field, (None, None)))
+        schema.append(pa.field(field, types.get(ARROW_TYPES.get(convert.__name__), pa.string())))
+    return pa.schema(schema)
+
+def to_int64(value):
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return int(value)
+
+def to_value(arrow_type):
+    if arrow_type == pa.int64():
+        return to_int64
+    if arrow_type == pa.float64():
+        return float
+    return str
+
+def to_arrow(schema, data, table=""):
+    # Values that don't fit the declared type are written as nulls and logged, typeof CHECKs that allow Null
+    # don't stop sqlite storing them
+    columns = list(zip(*data)) if data else [[] for _ in schema]
+    arrays = []
+    for field, col in zip(schema, columns):
+        convert, values, bad = to_value(field.type), [], 0
+        for i in col:
+            if i is None:
+                values.append(None)
+                continue
+            try:
+                values.append(convert(i))
+            except (TypeError, ValueError):
+                values.append(None)
+                bad += 1
+        if bad:
+            logger.warning(f"snapshot {table}.{field.name}: {bad} values aren't {field.type}, written as null")
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def partition_name(product):
+    # Directory safe product value, with a hash of the raw value when anything had to be replaced so that
+    # different products can't share a directory
+    if product is None:
+        return NULL_PARTITION
+    name = re.sub(r"[^\w\- .]", "_", str(product)).strip(" .")
+    if name != str(product) or not name:
+        name += "_" + hashlib.md5(str(product).encode()).hexdigest()[:8]
+    return name
+
+def write_table(table, path, fmt, compression):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if fmt == "parquet":
+        pq.write_table(table, path, compression=compression)
+    else:
+        # Uncompressed arrow files can be memory mapped and read zero-copy
+        feather.write_feather(table, path, compression=compression)
+
+def export_snapshots(db, run_date=None, fmt="parquet", compression=None, root=SNAPSHOT_DIR,
+                     tables=SUMMARY_TABLES + STAGING_TABLES):
+    if pa is None:
+        print("--INFO-- pyarrow is not installed, skipping snapshot export")
+        return []
+    run_date = run_date or datetime.now().strftime("%Y-%m-%d")
+    if compression is None:
+        compression = "zstd" if fmt == "parquet" else "uncompressed"
+    ext = "parquet" if fmt == "parquet" else "arrow"
+    written = []
+    for table in tables:
+        fields, data = db.execute_columns(f"select * from {table};")
+        schema = table_schema(db, table, fields)
+        run_dir = os.path.join(root, f"run_date={run_date}")
+        if "product" not in fields:
+            path = os.path.join(run_dir, f"{table}.{ext}")
+            write_table(to_arrow(schema, data, table), path, fmt, compression)
+            written.append(path)
+            continue
+        # Partition anything with a product column by product
+        x = fields.index("product")
+        partitions = {}
+        for row in data:
+            partitions.setdefault(row[x], []).append(row)
+        for product, rows in partitions.items():
+            path = os.path.join(run_dir, f"product={partition_name(product)}", f"{table}.{ext}")
+            write_table(to_arrow(schema, rows, table), path, fmt, compression)
+            written.append(path)
+    return written
+
+def read_snapshot(table, run_date, product=None, columns=None, root=SNAPSHOT_DIR):
+    path = os.path.join(root, f"run_date={run_date}")
+    if product is not None:
+        path = os.path.join(path, f"product={partition_name(product)}")
+    path = os.path.join(path, table)
+    if os.path.exists(f"{path}.arrow"):
+        return feather.read_table(f"{path}.arrow", columns=columns, memory_map=True)
+    return pq.read_table(f"{path}.parquet", columns=columns)
+
+if __name__ == "__main__":
+    db = sqlite_db("onprem_products.db")
+    for path in export_snapshots(db):
+        print(path)
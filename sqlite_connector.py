@@ -1,76 +1,297 @@
+import os
+import re
 import sqlite3
 import decimal
 import datetime
-import math
 import time
 import sys
+import pickle
+import tempfile
+from itertools import islice
 from collections import defaultdict
 import logging
+from query_telemetry import telemetry
+from progress import progress
 
-logging.basicConfig(filename='run.log', filemode="a", format='%(asctime)s %(message)s', level=logging.DEBUG)
+# Queries are logged as fingerprints with timings by query_telemetry, full text only when sampled
+logging.basicConfig(filename='run.log', filemode="a", format='%(asctime)s %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 CHUNKS = 100000
+# Statements kept prepared per connection, the summary and report queries are reused with bound parameters
+STATEMENT_CACHE = 256
+# Rows between progress updates inside a transaction
+PROGRESS_ROWS = 5000
+
+# Values from the Trino extracts are converted to what the column DDL accepts, e.g. arr in subscriptions is
+# CHECK (typeof(arr) in ('real')) so a Decimal has to arrive as a float. Converters are built once per table
+# from the declared types and CHECK constraints and run a column at a time on each batch.
+TYPEOF_CHECK = re.compile(r"typeof\(\s*[\"'`]?(\w+)[\"'`]?\s*\)\s+in\s*\(([^)]*)\)", re.I)
+DATES = (datetime.date, datetime.datetime, datetime.time)
+
+def to_integer(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value)
+    if isinstance(value, DATES):
+        return str(value)
+    return value
+
+def to_real(value):
+    if isinstance(value, (decimal.Decimal, int)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, DATES):
+        return str(value)
+    return value
+
+def to_text(value):
+    if isinstance(value, (decimal.Decimal,) + DATES):
+        return str(value)
+    return value
+
+def to_numeric(value):
+    # Untyped columns, whole Decimals become int and the rest float
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, DATES):
+        return str(value)
+    return value
+
+# Types sqlite3 can't bind or that a column converter would change, anything else is passed through untouched
+CONVERTED = {
+    to_integer: {decimal.Decimal, *DATES},
+    to_real: {decimal.Decimal, int, *DATES},
+    to_text: {decimal.Decimal, *DATES},
+    to_numeric: {decimal.Decimal, *DATES}
+}
+
+def column_converter(declared, allowed=None):
+    # allowed is the typeof() list from a CHECK constraint, it wins over the declared type's affinity
+    allowed = set(allowed or ()) - {"null"}
+    if allowed == {"integer"}:
+        return to_integer
+    if allowed == {"real"}:
+        return to_real
+    if allowed == {"text"}:
+        return to_text
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return to_integer
+    if any(i in declared for i in ("CHAR", "CLOB", "TEXT")):
+        return to_text
+    if any(i in declared for i in ("REAL", "FLOA", "DOUB")):
+        return to_real
+    return to_numeric
+
+def convert_rows(converters, rows):
+    # Column-wise over one batch, columns whose values need no conversion are left as they are
+    columns = list(zip(*rows))
+    changed = False
+    for x, convert in enumerate(converters):
+        if convert is None or x >= len(columns) or not set(map(type, columns[x])) & CONVERTED[convert]:
+            continue
+        columns[x] = list(map(convert, columns[x]))
+        changed = True
+    return list(zip(*columns)) if changed else rows
+
+# Result sets bigger than this many MB spill to a temp file, None keeps everything in memory.
+# Set with ONPREM_MEMORY_BUDGET_MB or onprem_report.py --memory-budget
+MEMORY_BUDGET_MB = float(os.environ["ONPREM_MEMORY_BUDGET_MB"]) if os.environ.get("ONPREM_MEMORY_BUDGET_MB") else None
+SPILL_BATCH = 10000
+
+def row_size(row):
+    return sys.getsizeof(row) + sum([sys.getsizeof(i) for i in row])
+
+class spill_result(object):
+    # Iterable result that keeps rows in memory up to budget_mb and pickles the rest to a temp file in batches
+    def __init__(self, budget_mb=None, rows=()):
+        budget_mb = budget_mb or MEMORY_BUDGET_MB
+        self.budget = budget_mb * 1024 * 1024 if budget_mb else None
+        self.rows = []
+        self.size = 0
+        self.pending = []
+        self.spilled = 0
+        self.spill = None
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.rows) + self.spilled + len(self.pending)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def append(self, row):
+        if self.spill is not None:
+            self.pending.append(row)
+            if len(self.pending) >= SPILL_BATCH:
+                self.flush()
+            return
+        self.rows.append(row)
+        if self.budget is None:
+            return
+        # Sizing every row is slow, after the first thousand use the running average
+        if len(self.rows) <= 1000:
+            self.size += row_size(row)
+        else:
+            self.size += self.size / (len(self.rows) - 1)
+        if self.size > self.budget:
+            self.spill = tempfile.TemporaryFile(prefix="spill_", suffix=".pkl")
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        if self.pending:
+            self.spill.seek(0, 2)
+            pickle.dump(self.pending, self.spill, protocol=pickle.HIGHEST_PROTOCOL)
+            self.spilled += len(self.pending)
+            self.pending = []
+
+    def __iter__(self):
+        yield from self.rows
+        if self.spill is None:
+            return
+        self.flush()
+        self.spill.seek(0)
+        while True:
+            try:
+                batch = pickle.load(self.spill)
+            except EOFError:
+                break
+            yield from batch
+
+    def __getitem__(self, i):
+        # Reads the spill file only as far as the rows asked for, never the whole result into a list
+        if isinstance(i, slice):
+            r = range(*i.indices(len(self)))
+            if not r:
+                return []
+            if r.step > 0:
+                return list(islice(self, r.start, r.stop, r.step))
+            return list(islice(self, r[-1], r[0] + 1))[::-1][::-r.step]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("spill_result index out of range")
+        if i < len(self.rows):
+            return self.rows[i]
+        return next(islice(self, i, None))
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
 
 class sqlite_db(object):
-    def __init__(self, db_file):
+    def __init__(self, db_file, read_only=False, check_same_thread=True):
+        # check_same_thread=False for connections handed between threads by a pool, one thread at a time
         self.db_file = db_file
-        self.connection = sqlite3.connect(self.db_file)
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE,
+                                              check_same_thread=check_same_thread)
+        else:
+            self.connection = sqlite3.connect(self.db_file, cached_statements=STATEMENT_CACHE,
+                                              check_same_thread=check_same_thread)
         self.cursor = self.connection.cursor()
+        self.schemas = {}
 
-    def printProgressBar (self, iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', printEnd="\r"):
-        percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-        filledLength = int(length * iteration // total)
-        bar = fill * filledLength + '-' * (length - filledLength)
-        print(f'\r{prefix} |{bar}| {percent}% {suffix}', end = printEnd)
-        # Print New Line on Complete
-        if iteration == total:
-            sys.stdout.write("\033[K") # Clear to the end of line
-            #print(" " * 120, end="\r")
-
-    def execute(self, query):
-        logger.info(query)
-        self.cursor.execute(query)
-        data = self.cursor.fetchall()
-        self.connection.commit()
+    def column_types(self, table):
+        # {column: (declared type, [types allowed by a typeof CHECK])}, empty for a table that doesn't exist
+        if table not in self.schemas:
+            columns = {i[1]: (i[2], None) for i in self.cursor.execute(f"pragma table_info('{table}');")}
+            ddl = self.cursor.execute(
+                "select sql from sqlite_master where type = 'table' and name = ? "
+                "union all select sql from sqlite_temp_master where type = 'table' and name = ?;",
+                (table, table)).fetchone()
+            for column, allowed in TYPEOF_CHECK.findall(ddl[0] if ddl and ddl[0] else ""):
+                if column in columns:
+                    columns[column] = (columns[column][0], [i.strip(" '\"").lower() for i in allowed.split(",")])
+            self.schemas[table] = columns
+        return self.schemas[table]
+
+    def converters(self, table, fields):
+        # One conversion function per field, in field order
+        columns = self.column_types(table)
+        return [column_converter(*columns.get(i, (None, None))) for i in fields]
+
+    def fetch(self, spill_mb=None):
+        # Plain list unless a memory budget is set, then rows stream into a spill_result
+        if not (spill_mb or MEMORY_BUDGET_MB):
+            return self.cursor.fetchall()
+        data = spill_result(spill_mb)
+        while True:
+            rows = self.cursor.fetchmany(SPILL_BATCH)
+            if not rows:
+                break
+            data.extend(rows)
         return data
 
-    def execute_dict(self, query):
+    def execute(self, query, params=(), spill_mb=None):
+        with telemetry.timer(query) as t:
+            self.cursor.execute(query, params)
+            data = self.fetch(spill_mb)
+            self.connection.commit()
+            t.rows = len(data)
+        return data
+
+    def execute_dict(self, query, params=()):
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
-        self.cursor.execute(query)
-        data = self.cursor.fetchall()
-        self.connection.commit()
+        with telemetry.timer(query) as t:
+            self.cursor.execute(query, params)
+            data = self.cursor.fetchall()
+            self.connection.commit()
+            t.rows = len(data)
         self.connection.row_factory = None
         self.cursor = self.connection.cursor()
         return data
 
+    def execute_columns(self, query, params=(), spill_mb=None):
+        # Column names plus plain tuples, lighter than sqlite3.Row for wide scans
+        with telemetry.timer(query) as t:
+            self.cursor.execute(query, params)
+            fields = [i[0] for i in self.cursor.description]
+            data = self.fetch(spill_mb)
+            self.connection.commit()
+            t.rows = len(data)
+        return fields, data
+
     def chunks(self, data, rows=CHUNKS):
-            for i in range(0, len(data), rows):
-                yield data[i:i+rows]
+        # Works on lists and on spill_results or any other iterable
+        data = iter(data)
+        while True:
+            chunk = list(islice(data, rows))
+            if not chunk:
+                break
+            yield chunk
 
-    def insert(self, table, fields, data, del_table=False):
+    def insert(self, table, fields, data, del_table=False, stage=None):
         start = time.time()
         # data is a list of lists with the primary key as the first item
+        # stage is a progress stage owned by the caller, e.g. one per extract when data arrives in batches
         if del_table: self.execute(f"DELETE from {table};")
+        if not data: return
 
-        chunks = self.chunks(data)
-        counter, total = 0, math.ceil(float(len(data)/CHUNKS))
-        self.printProgressBar(counter, total)
-        for chunk in chunks:
-            counter += 1
-            if total > 1: self.printProgressBar(counter, total)
-            self.cursor.execute("BEGIN TRANSACTION")
-            query = f"""
-            INSERT INTO {table}
-            ('{"', '".join(fields)}')
-            VALUES
-            ({", ".join("?" * len(data[0]))});
-            """
-            for row in chunk:
-                self.cursor.execute(query, row)
-            self.cursor.execute("COMMIT")
-        logger.info(f"Took {time.time() - start} seconds to do insert of {len(data)} rows into {table}")
+        own_stage = stage is None
+        if own_stage:
+            stage = progress.stage(f"insert {table}", total=len(data))
+        converters = self.converters(table, fields)
+        try:
+            for chunk in self.chunks(data):
+                self.cursor.execute("BEGIN TRANSACTION")
+                query = f"""
+                INSERT INTO {table}
+                ('{"', '".join(fields)}')
+                VALUES
+                ({", ".join("?" * len(chunk[0]))});
+                """
+                for batch in self.chunks(chunk, PROGRESS_ROWS):
+                    self.cursor.executemany(query, convert_rows(converters, batch))
+                    stage.update(len(batch))
+                self.cursor.execute("COMMIT")
+        finally:
+            if own_stage: stage.done()
+        telemetry.record(f"INSERT INTO {table} ({', '.join(fields)})", time.time() - start, len(data))
 
     def flatten_dict(data):
         for row in list(data):
@@ -103,12 +324,8 @@ class sqlite_db(object):
 
         start = time.time()
         chunks = self.chunks(data)
-        counter, total = 0, math.ceil(float(len(data)/CHUNKS))
-        #self.printProgressBar(counter, total)
         fields = [i for i in data[0].keys()]
         for chunk in chunks:
-            counter += 1
-            #if total > 1: self.printProgressBar(counter, total)
             self.cursor.execute("BEGIN TRANSACTION")
             query = f"""
             INSERT INTO {table}
@@ -123,29 +340,20 @@ class sqlite_db(object):
             logger.info(f"Took {time.time() - start} seconds to do insert of {len(data)} rows into {table}")
 
     def update(self, table, fields, data):
-        chunks = self.chunks(data)
-        for chunk in chunks:
+        # fields[0] is the key the rows are matched on, rows with nothing but the key are skipped
+        start, count = time.time(), 0
+        stage = progress.stage(f"update {table}", total=len(data) if hasattr(data, "__len__") else None)
+        query = f"UPDATE {table} SET {', '.join(f'{i} = ?' for i in fields[1:])} WHERE {fields[0]} = ?;"
+        # The key moves to the end to match the WHERE clause
+        converters = self.converters(table, fields[1:]) + [None]
+        for chunk in self.chunks(data):
+            count += len(chunk)
             self.cursor.execute("BEGIN TRANSACTION")
-            for row in chunk:
-                # Check if everything except the PK is None
-                if all(elem is None for elem in row[1:]):
-                    continue
-                query = f"UPDATE {table} SET "
-                for x, i in enumerate(row):
-                    # Type checking and data validation
-                    if x == 0 : continue
-                    #if not i and i != 0:
-                    #    continue
-                    if isinstance(i, float) or isinstance(i, int):
-                        pass
-                    elif i is None:
-                        i = "NULL"
-                    elif isinstance(i, decimal.Decimal):
-                        i = int(i)
-                    elif isinstance(i, datetime.datetime) or isinstance(i, datetime.date) or " " in i or not i.isnumeric():
-                        i = str(i).replace("\'", "\'\'")
-                        i = f"'{i}'"
-                    query += f"{fields[x]} = {i}, "
-                query = query[:-2] + f" WHERE {fields[0]} = '{row[0]}';"
-                self.cursor.execute(query)
+            for batch in self.chunks(chunk, PROGRESS_ROWS):
+                rows = [list(row[1:]) + [row[0]] for row in batch if any(i is not None for i in row[1:])]
+                if rows:
+                    self.cursor.executemany(query, convert_rows(converters, rows))
+                stage.update(len(batch))
             self.cursor.execute("COMMIT")
+        stage.done()
+        telemetry.record(f"UPDATE {table} SET {', '.join(fields[1:])} WHERE {fields[0]}", time.time() - start, count)
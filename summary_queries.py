@@ -0,0 +1,334 @@
+import re
+import json
+import time
+import zlib
+from query_telemetry import telemetry
+
+# Summary queries are defined once with named parameters, so the statement text is the same for every product
+# and CTA type and sqlite3's per-connection statement cache prepares each of them only once
+# Parameters: :product, :codes (json array of report product codes, read with json_each) and :cta_type
+
+QUERIES = {
+    # Installation level
+    "inst_installations": """
+    select * from installations where product = :product;
+    """,
+    "inst_accounts": """
+    select i.inst_id, a.*
+    from installations i
+    left join accounts a on i.acct_id = a.acct_id
+    where i.product = :product;
+    """,
+    # Provides metrics related only to the next renewal for the product in question
+    "inst_next_renewal": """
+    select i.inst_id,
+    n.close_date,
+    n.renewal_qt,
+    n.forecast,
+    n.acv as opp_acv,
+    n.opp_count
+    from installations i
+    join next_renewal n on n.product = i.product and n.acct_id = i.acct_id
+    where i.product = :product;
+    """,
+    # Those opportunities that apply *CBLO can be multiple so its omitted + wtf is other?
+    "inst_opportunities": """
+    select i.inst_id,
+    min(o.close_date) as close_date,
+    o.renewal_qt,
+    o.forecast,
+    o.acv as opp_acv,
+    count(*) as opp_count
+    from installations i
+    join opportunities o on i.acct_id = o.acct_id
+    where i.product = :product
+    and o.opp_id in (
+        select row_id from product_codes
+        where source = 'opportunities'
+        and product_code in (select value from json_each(:codes)))
+    group by i.inst_id;
+    """,
+    # Arr from just the product in question
+    "inst_sub_arr": """
+    select i.inst_id,
+    round(sum(s.arr), 2) sub_product_arr
+    from installations i
+    left join subscriptions s on i.acct_id = s.acct_id and i.product = s.product
+    where 1=1
+    and i.product = :product
+    group by i.inst_id
+    """,
+    # CTAs from gainsight, run once per CTA type
+    "inst_cta": """
+    select i.inst_id,
+    max(c.closed_date) as cta_date
+    from installations i
+    left join ctas c on i.acct_id = c.acct_id
+    where c.cta_type = :cta_type
+    and c.status = 'Closed'
+    and i.product = :product
+    group by i.inst_id
+    """,
+    # CSE Timeline activities
+    "inst_timeline": """
+    select i.inst_id,
+    max(cse.activity_date) as 'last_timeline'
+    from installations i
+    left join cse_activity cse on cse.acct_id = i.acct_id
+    where i.product = :product
+    group by i.inst_id
+    """,
+
+    # Account level
+    # Seed table with just the accounts that have the product in question
+    "acct_seed": """
+    select acct_id from installations where product = :product;
+    """,
+    "acct_accounts": """
+    select *, :product as product from accounts;
+    """,
+    # Timeline, deployment, subscription and enforcement metrics, maintained by refresh_metrics
+    "acct_metrics": """
+    select acct_id,
+    last_timeline,
+    connected_count,
+    disconnected_count,
+    licenses_purchased,
+    product_acv,
+    sub_deployment_perc,
+    inst_deployment_perc,
+    le, le_perc,
+    me, me_perc,
+    he, he_perc
+    from acct_metrics
+    where product = :product;
+    """,
+    "acct_cta": """
+    select acct_id,
+    closed_date as cta_date
+    from acct_cta_metrics
+    where cta_type = :cta_type;
+    """,
+    # Partners and aliases from installations. group_concat has no ORDER BY before SQLite 3.44, the sorted
+    # subquery keeps the lists in value order in practice but SQLite doesn't guarantee it
+    "acct_deployment": """
+    select a.acct_id,
+    group_concat(distinct i.monitoring_partner) as monitoring_partner,
+    group_concat(distinct i.cb_alias) as cb_alias
+    from accounts a
+    left join (
+        select acct_id, monitoring_partner, cb_alias
+        from installations
+        where product = :product
+        order by acct_id, cb_alias, monitoring_partner) i on a.acct_id = i.acct_id
+    where i.acct_id is not null
+    group by a.acct_id;
+    """,
+    # Whether any of the account's installations of the product has a hosted S3 bucket
+    "acct_s3": """
+    select a.acct_id,
+    exists (
+        select 1
+        from installations i
+        join aliases al on al.alias = i.cb_alias
+        where i.acct_id = a.acct_id
+        and i.product = :product
+        and al.s3_bucket_name is not null) as s3_bucket
+    from accounts a;
+    """,
+    "acct_next_renewal": """
+    select acct_id,
+    close_date as renewal_date,
+    renewal_qt,
+    forecast
+    from next_renewal
+    where product = :product;
+    """,
+    "acct_opportunities": """
+    select o.acct_id,
+    group_concat(o.close_date) as renewal_date,
+    group_concat(o.renewal_qt) as renewal_qt,
+    group_concat(o.forecast) as forecast
+    from opportunities o
+    where o.opp_id in (
+        select row_id from product_codes
+        where source = 'opportunities'
+        and product_code in (select value from json_each(:codes)))
+    group by o.acct_id;
+    """,
+    "acct_products": """
+    select acct_id,
+    replace(group_concat(distinct product_code), ',', ', ') as products
+    from (
+        select pc.acct_id, pc.product_code
+        from (select distinct acct_id from installations where product = :product) i
+        join product_codes pc on pc.acct_id = i.acct_id
+        where pc.source in ('installations', 'subscriptions')
+        order by pc.acct_id, pc.product_code)
+    group by acct_id
+    """,
+
+    # Installations that haven't checked in within 5 days of the product's latest contact
+    "air_gapped": """
+    select
+    i.inst_id,
+    case
+    when i.last_contact >
+        DATE((select max(last_contact) from installations where product = :product), '-5 Days')
+        then False else True end
+    from installations i
+    where i.product = :product;
+    """
+}
+
+# Order the queries are merged into each summary, "renewal" is next_renewal or opportunities
+INST_SUMMARY = ("inst_installations", "inst_accounts", "renewal", "inst_sub_arr", "inst_cta", "inst_timeline")
+ACCT_SUMMARY = ("acct_accounts", "acct_metrics", "acct_cta", "acct_deployment", "acct_s3", "renewal",
+                "acct_products")
+
+def summary_params(product, codes=()):
+    return {"product": product, "codes": json.dumps(list(codes))}
+
+def cta_column(cta):
+    # Summary column for a CTA reason, anything that isn't a word character becomes _
+    return re.sub(r"\W+", "_", cta.lower()).strip("_")
+
+def summary_steps(level, next_renewal=False):
+    steps = INST_SUMMARY if level == "inst" else ACCT_SUMMARY
+    renewal = f"{level}_next_renewal" if next_renewal else f"{level}_opportunities"
+    return [renewal if i == "renewal" else i for i in steps]
+
+def run_summary(db, rows, level, params, next_renewal=False, cta_types=()):
+    # Merges every query for the level into rows (a summary_table), CTA queries run once per type and
+    # their date column is renamed after the CTA
+    for name in summary_steps(level, next_renewal):
+        if name.endswith("_cta"):
+            for cta in cta_types:
+                fields, data = db.execute_columns(QUERIES[name], dict(params, cta_type=cta))
+                rows.add([fields[0], cta_column(cta)], data)
+            continue
+        rows.add(*db.execute_columns(QUERIES[name], params))
+    return rows
+
+# acct_metrics and acct_cta_metrics hold the account level aggregates per (acct_id, product). Triggers on the
+# source tables (see table_creations) record changed accounts in acct_metrics_dirty and refresh_metrics
+# recomputes only those, so after an incremental load the cost follows the rows that changed.
+METRIC_QUERIES = (
+    """
+    delete from acct_metrics where acct_id in (select acct_id from acct_metrics_dirty);
+    """,
+    """
+    insert into acct_metrics
+    with dirty as (select acct_id from acct_metrics_dirty),
+    keys as (
+        select acct_id, product from installations where acct_id in dirty
+        union
+        select acct_id, product from subscriptions where acct_id in dirty),
+    inst as (
+        select acct_id, product,
+        sum(case when air_gapped = 0 then normalized_host_count end) as connected_count,
+        sum(case when air_gapped = 1 then normalized_host_count end) as disconnected_count,
+        sum(normalized_host_count) as host_count,
+        max(licenses_purchased) as licenses,
+        max(case when air_gapped = 0 then licenses_purchased end) as connected_licenses,
+        sum(case when air_gapped = 0 then le end) as le,
+        sum(case when air_gapped = 0 then me end) as me,
+        sum(case when air_gapped = 0 then he end) as he
+        from installations
+        where acct_id in dirty
+        group by acct_id, product),
+    subs as (
+        select acct_id, product,
+        sum(quantity) as quantity,
+        sum(arr) as arr
+        from subscriptions
+        where acct_id in dirty
+        group by acct_id, product),
+    timeline as (
+        select acct_id,
+        max(activity_date) as last_timeline
+        from cse_activity
+        where acct_id in dirty
+        group by acct_id)
+    select k.acct_id, k.product,
+    t.last_timeline,
+    i.connected_count,
+    i.disconnected_count,
+    s.quantity,
+    s.arr,
+    round(cast(i.connected_count as real) / s.quantity * 100, 2),
+    round(cast(i.host_count as real) / i.licenses * 100, 2),
+    i.le, round(cast(i.le as real) / i.connected_licenses * 100, 2),
+    i.me, round(cast(i.me as real) / i.connected_licenses * 100, 2),
+    i.he, round(cast(i.he as real) / i.connected_licenses * 100, 2)
+    from keys k
+    left join inst i on i.acct_id = k.acct_id and i.product = k.product
+    left join subs s on s.acct_id = k.acct_id and s.product = k.product
+    left join timeline t on t.acct_id = k.acct_id;
+    """,
+    """
+    delete from acct_cta_metrics where acct_id in (select acct_id from acct_metrics_dirty);
+    """,
+    """
+    insert into acct_cta_metrics
+    select a.acct_id, c.cta_type, max(c.closed_date)
+    from accounts a
+    join ctas c on a.acct_id = c.acct_id
+    where c.status = 'Closed'
+    and a.acct_id in (select acct_id from acct_metrics_dirty)
+    group by a.acct_id, c.cta_type;
+    """,
+    """
+    delete from acct_metrics_dirty;
+    """
+)
+
+def refresh_metrics(db):
+    # Applies the pending account changes in one transaction, returns how many accounts were recomputed
+    start = time.time()
+    dirty = db.execute("select count(*) from acct_metrics_dirty;")[0][0]
+    if not dirty:
+        return 0
+    db.cursor.execute("BEGIN TRANSACTION")
+    for query in METRIC_QUERIES:
+        db.cursor.execute(query)
+    db.cursor.execute("COMMIT")
+    telemetry.record("refresh acct_metrics", time.time() - start, dirty)
+    return dirty
+
+# Every table the summary queries drive from or join on acct_id is copied per shard, so a worker computes
+# only its own accounts. The rest (subscriptions, ctas, cse_activity, aliases, product_codes) are reached
+# through these by index. Table: its unique key, main table primary keys aren't in sqlite_master.
+SHARD_TABLES = {
+    "installations": "inst_id",
+    "accounts": "acct_id",
+    "opportunities": "opp_id",
+    "next_renewal": "product, acct_id",
+    "acct_metrics": "acct_id, product",
+    "acct_cta_metrics": "acct_id, cta_type"
+}
+
+def acct_shard(acct_id, shards):
+    # Stable across processes and runs, unlike hash()
+    if acct_id is None:
+        return 0
+    return zlib.crc32(str(acct_id).encode()) % shards
+
+INDEX_NAME = re.compile(r"^(CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?)", re.I)
+
+def shard_tables(db, shard, shards):
+    # Temp tables take precedence over main tables of the same name, so the queries above run unchanged on
+    # one shard of the accounts. The temp schema stays writable on read-only connections.
+    db.connection.create_function("acct_shard", 2, acct_shard, deterministic=True)
+    for table, key in SHARD_TABLES.items():
+        db.execute(f"""
+        CREATE TEMP TABLE {table} AS
+        SELECT * FROM main.{table}
+        WHERE acct_shard(acct_id, ?) = ?;
+        """, (shards, shard))
+        db.execute(f"CREATE UNIQUE INDEX temp.{table}_shard_key on {table}({key});")
+        # The main table's own indexes as well, or every join on acct_id scans the whole shard per row
+        indexes = db.execute("select sql from sqlite_master where type = 'index' and tbl_name = ? and sql is not null;",
+                             (table,))
+        for (sql,) in indexes:
+            db.execute(INDEX_NAME.sub(r"\1temp.", sql.strip()))
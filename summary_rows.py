@@ -0,0 +1,50 @@
+class summary_table(object):
+    # Rows for the summary builders stored column-wise: one list per column and a key -> position map,
+    # instead of a dict per row that repeats every column name
+    __slots__ = ("key", "fields", "columns", "index", "grow")
+
+    def __init__(self, key, keys=(), grow=True):
+        self.key = key
+        self.fields = []
+        self.columns = {}
+        self.index = {}
+        # When False, rows for keys that weren't seeded are ignored
+        self.grow = grow
+        for k in keys:
+            self.add_key(k)
+
+    def __len__(self):
+        return len(self.index)
+
+    def add_key(self, k):
+        if k not in self.index:
+            self.index[k] = len(self.index)
+            for col in self.columns.values():
+                col.append(None)
+        return self.index[k]
+
+    def add(self, fields, data):
+        # Same contract as the old add_metric: the first column is the key, every other column becomes
+        # a field and keys without a row in data get None
+        cols = []
+        for field in fields[1:]:
+            if field == self.key:
+                cols.append(None)
+                continue
+            if field not in self.columns:
+                self.fields.append(field)
+                self.columns[field] = [None] * len(self.index)
+            cols.append(self.columns[field])
+        for row in data:
+            x = self.index.get(row[0])
+            if x is None:
+                if not self.grow: continue
+                x = self.add_key(row[0])
+            for col, value in zip(cols, row[1:]):
+                if col is not None:
+                    col[x] = value
+        return self
+
+    def rows(self):
+        cols = [self.columns[i] for i in self.fields]
+        return [[k] + [col[x] for col in cols] for k, x in self.index.items()]
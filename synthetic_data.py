@@ -0,0 +1,93 @@
+import random
+from datetime import date, timedelta
+from onprem_report import table_creations, report_data, create_summaries
+from sqlite_connector import sqlite_db
+from product_catalog import catalog
+
+# Synthetic onprem_products database for benchmarks, plan checks and local testing of the report server
+# usage: python synthetic_data.py [installations] [db_file], the command line build includes the summaries
+
+PRODUCTS = tuple(catalog.installed)
+OPP_FAMILIES = ("CBRC", "Hosted EDR", "CBP", "CBR", "CBD", "CBTH", "CBRC;Hosted EDR", "CBP;Application Control")
+SUB_PRODUCTS = PRODUCTS + ("Carbon Black Endpoint Standard", "Cb ThreatHunter", "Cb Workload")
+CTA_REASONS = ("Product Usage Analytics", "Tech Assessment", "CSA Whiteboarding")
+TIERS = ("Low", "Medium", "High", "Holding")
+GEOS = ("AMER", "EMEA", "APJ")
+
+def day(offset):
+    return (date.today() + timedelta(days=offset)).strftime("%Y-%m-%d")
+
+def build_database(db_file, installations=1000, seed=1, summaries=False):
+    random.seed(seed)
+    table_creations(db_file)
+    db = sqlite_db(db_file)
+    n_accts = max(1, installations // 3)
+    csms = [f"CSM {i}" for i in range(max(1, n_accts // 30))]
+    managers = [f"Manager {i}" for i in range(max(1, len(csms) // 8))]
+
+    accounts = []
+    for x in range(n_accts):
+        csm = random.choice(csms)
+        accounts.append([f"acct{x:07d}", random.choice(TIERS), random.randint(0, 2000000), f"Account {x} Inc.",
+                         random.randint(0, 100), "comments", random.randint(0, 100), "adoption",
+                         csm, managers[csms.index(csm) % len(managers)], f"CSE {x % 40}", f"AM {x % 60}",
+                         random.choice(GEOS), "Sub division", "Country", random.choice([None, "Partner"])])
+    fields = ["acct_id", "tier", "arr", "account_name", "csm_score", "csm_comments"]
+    fields += ["gs_score", "adoption_comments", "csm", "csm_manager", "cse", "account_manager"]
+    fields += ["vmw_geo", "vmw_sub_div", "vmw_country", "cs_partner"]
+    db.insert("accounts", fields, accounts)
+
+    insts = []
+    for x in range(installations):
+        licenses = random.randint(10, 50000)
+        insts.append([f"inst{x:08d}", licenses, random.randint(0, licenses), day(-random.randint(0, 30)),
+                      f"acct{random.randrange(n_accts):07d}", random.choice(PRODUCTS), f"sid{x}",
+                      random.randint(0, licenses), random.randint(0, licenses), random.randint(0, licenses),
+                      f"alias_{x}", random.choice([None, "Monitoring Partner"])])
+    fields = ("inst_id", "licenses_purchased", "normalized_host_count", "last_contact", "acct_id", "product",
+              "sid", "le", "me", "he", "cb_alias", "monitoring_partner")
+    db.insert("installations", fields, insts)
+
+    opps = [[f"opp{x:08d}", f"acct{x % n_accts:07d}", random.randint(0, 500000), random.choice(["Commit", "Upside"]),
+             day(random.randint(1, 700)), random.choice(OPP_FAMILIES)] for x in range(n_accts * 2)]
+    db.insert("opportunities", ("opp_id", "acct_id", "acv", "forecast", "close_date", "type"), opps)
+
+    subs = [[f"acct{x % n_accts:07d}", float(random.randint(0, 300000)), day(random.randint(1, 1000)), f"sub{x:08d}",
+             "description", f"prod{x % 20}", random.choice(SUB_PRODUCTS), random.randint(1, 50000),
+             random.choice([12, 24, 36]), float(random.randint(0, 900000))] for x in range(n_accts * 3)]
+    fields = ["acct_id", "arr", "end_date", "sub_id", "description", "product_id", "product", "quantity", "sub_term", "tcv"]
+    db.insert("subscriptions", fields, subs)
+
+    ctas = [[f"acct{random.randrange(n_accts):07d}", random.choice(CTA_REASONS), day(-random.randint(1, 700)),
+             random.choice(["Open", "Closed"])] for x in range(n_accts * 2)]
+    db.insert("ctas", ("acct_id", "cta_type", "closed_date", "status"), ctas)
+
+    # Spreadsheet style names: case, punctuation and legal suffix variants of the account names
+    spellings = ("Account {} Inc.", "ACCOUNT {}, INC", "account {}", "Account {} Incorporated", "The Account {} LLC")
+    activity = [[random.choice(spellings).format(random.randrange(n_accts)), day(-random.randint(1, 365))]
+                for x in range(n_accts * 2)]
+
+    # Spreadsheet spelling of the aliases, normalised by load_aliases
+    s3 = [[f"Alias-{x}", f"bucket-{x}"] for x in random.sample(range(installations), installations // 10)]
+
+    # Same derived columns the pipeline computes after extraction
+    rd = report_data(db_file, connect=False)
+    rd.load_activity(activity)
+    rd.load_aliases(s3)
+    rd.renewal_quarter()
+    rd.deployment_percentage()
+    rd.enforcement_levels()
+    rd.air_gapped()
+    rd.product_family()
+
+    # acct_summary/inst_summary as well, e.g. for the report server
+    if summaries:
+        for product in PRODUCTS:
+            create_summaries(db, product)
+    return db_file
+
+if __name__ == "__main__":
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    db_file = sys.argv[2] if len(sys.argv) > 2 else "synthetic_products.db"
+    print(build_database(db_file, n, summaries=True))
@@ -1,29 +1,89 @@
 import trino
 import json
+import time
+import asyncio
 from collections import defaultdict
+from query_telemetry import telemetry
+import sqlite_connector
+from sqlite_connector import spill_result
+
+FETCH_ROWS = 10000
+
+def connection_settings(settings_file="settings.conf"):
+    with open(settings_file, "r") as f:
+        settings = json.load(f)
+        server = settings["tesseract_server"]
+        port = settings["tesseract_port"]
+        username = settings["tesseract_user"]
+        password = settings["tesseract_password"]
+    return {
+        "host": server,
+        "port": port,
+        "user": username,
+        "auth": trino.auth.BasicAuthentication(username,  password),
+        "http_scheme": "https"}
 
 class tesseract_connection(object):
     def __init__(self):
-        with open("settings.conf", "r") as f:
-            settings = json.load(f)
-            server = settings["tesseract_server"]
-            port = settings["tesseract_port"]
-            username = settings["tesseract_user"]
-            password = settings["tesseract_password"]
-        self.conn = trino.dbapi.connect(
-            host=server,
-            port=port,
-            user=username,
-            auth=trino.auth.BasicAuthentication(username,  password),
-            http_scheme="https")
+        self.conn = trino.dbapi.connect(**connection_settings())
         self.cur = self.conn.cursor()
 
-    def execute(self, query, dict=False):
-        data = self.cur.execute(query) #.fetchall()
-        if dict:
-            d = defaultdict(list)
-            for r in data:
-                d[r[0]].append(r[1])
-            return d
-        return [list(i) for i in data]
+    def execute(self, query, dict=False, spill_mb=None):
+        with telemetry.timer(query) as t:
+            data = self.cur.execute(query) #.fetchall()
+            if dict:
+                d = defaultdict(list)
+                for r in data:
+                    d[r[0]].append(r[1])
+                t.rows = len(d)
+                return d
+            if spill_mb or sqlite_connector.MEMORY_BUDGET_MB:
+                data = spill_result(spill_mb, (list(i) for i in data))
+            else:
+                data = [list(i) for i in data]
+            t.rows = len(data)
+        return data
+
+class async_tesseract_connection(object):
+    # The trino client is blocking, each query gets its own connection on a worker thread
+    # and the semaphore caps how many run against the cluster at once
+    def __init__(self, max_concurrency=4):
+        self.settings = connection_settings()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def fetch_all(self, query):
+        conn = trino.dbapi.connect(**self.settings)
+        try:
+            with telemetry.timer(query) as t:
+                cur = conn.cursor()
+                cur.execute(query)
+                if sqlite_connector.MEMORY_BUDGET_MB:
+                    data = spill_result(None, (list(i) for i in cur))
+                else:
+                    data = [list(i) for i in cur.fetchall()]
+                t.rows = len(data)
+            return data
+        finally:
+            conn.close()
+
+    async def execute(self, query):
+        async with self.semaphore:
+            return await asyncio.to_thread(self.fetch_all, query)
 
+    async def iterate(self, query, batch_size=FETCH_ROWS):
+        # Yields lists of rows as they arrive instead of waiting for the whole result
+        async with self.semaphore:
+            conn = await asyncio.to_thread(trino.dbapi.connect, **self.settings)
+            start, rows = time.perf_counter(), 0
+            try:
+                cur = conn.cursor()
+                await asyncio.to_thread(cur.execute, query)
+                while True:
+                    batch = await asyncio.to_thread(cur.fetchmany, batch_size)
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    yield [list(i) for i in batch]
+            finally:
+                conn.close()
+                telemetry.record(query, time.perf_counter() - start, rows)